@@ -0,0 +1,210 @@
+"""A local stand in for e621.net's post/index.json, pool/show.json and file CDN, for benchmarking without a network
+
+The catalog is generated rather than stored: each file is its post id followed by a shared block of bytes, so only the
+md5s need to be kept in memory however many posts there are."""
+import json
+import time
+import random
+import struct
+import hashlib
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+from typing import Dict, Any
+
+# posts per pool/show.json page, the same as e621
+POOL_PAGE_SIZE = 24
+
+# the pool that pool/show.json serves, made up of the oldest posts in the catalog
+POOL_ID = 1
+
+
+class MockCatalog:
+    def __init__(self, posts: int, file_size: int, tags: str = 'mock', pool_size: int = 0, pool_post_ids: bool = False,
+                 pool_post_count: bool = True):
+        self.file_size = max(8, file_size)
+        # include the newer API's post_ids list, and the post_count, in pool/show.json responses
+        self.pool_post_ids = pool_post_ids
+        self.pool_post_count = pool_post_count
+        self.tags = tags
+        self._block = bytes(random.Random(0).getrandbits(8) for _ in range(0, self.file_size - 8))
+        self.posts = [self._make_post(post_id) for post_id in range(1, posts + 1)]
+        self.pool = self.posts[:pool_size]
+        self.by_md5 = {post['md5']: post for post in self.posts}
+
+    def file_data(self, post_id: int) -> bytes:
+        return struct.pack('>Q', post_id) + self._block
+
+    def _make_post(self, post_id: int) -> Dict[str, Any]:
+        return {'id': post_id, 'md5': hashlib.md5(self.file_data(post_id)).hexdigest(), 'file_ext': 'png',
+                'file_size': self.file_size, 'tags': self.tags, 'score': post_id % 50, 'rating': 's'}
+
+
+class MockE621Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, content_type: str = 'application/json', headers: Dict[str, str] = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self._write_throttled(body)
+
+    def _write_throttled(self, body: bytes):
+        bandwidth = self.server.bandwidth
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+
+        # write in roughly 10ms slices to hold each connection to the bandwidth limit
+        chunk_size = max(1024, bandwidth // 100)
+        for offset in range(0, len(body), chunk_size):
+            chunk = body[offset:offset + chunk_size]
+            self.wfile.write(chunk)
+            time.sleep(len(chunk) / bandwidth)
+
+    def _send_json(self, body: bytes):
+        """Listings get an ETag, and a 304 if the client already has this version"""
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.server.count('not_modified')
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self._send(200, body, headers={'ETag': etag})
+
+    def _post_json(self, post: Dict[str, Any]) -> Dict[str, Any]:
+        result = dict(post)
+        result['file_url'] = 'http://{}/data/{}.{}'.format(self.headers['Host'], post['md5'], post['file_ext'])
+        return result
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            self.server.count('errors')
+            self._send(503, b'{"success": false, "reason": "mock error"}', headers={'Retry-After': '0'})
+            return
+
+        if url.path == '/post/index.json':
+            self._post_index(query)
+        elif url.path == '/pool/show.json':
+            self._pool_show(query)
+        elif url.path.startswith('/data/'):
+            self._file(url.path[len('/data/'):])
+        else:
+            self._send(404, b'{"success": false, "reason": "not found"}')
+
+    def _post_index(self, query: Dict[str, str]):
+        self.server.count('api')
+        catalog = self.server.catalog
+        limit = int(query.get('limit', 75))
+        before_id = int(query.get('before_id', len(catalog.posts) + 1))
+
+        # newest first, same as e621
+        first = min(before_id - 1, len(catalog.posts))
+        posts = catalog.posts[max(0, first - limit):first]
+        body = json.dumps([self._post_json(post) for post in reversed(posts)]).encode()
+        self._send_json(body)
+
+    def _pool_show(self, query: Dict[str, str]):
+        self.server.count('api')
+        catalog = self.server.catalog
+        if int(query.get('id', 0)) != POOL_ID:
+            self._send(404, b'{"success": false, "reason": "not found"}')
+            return
+
+        page = int(query.get('page', 1))
+        posts = catalog.pool[(page - 1) * POOL_PAGE_SIZE:page * POOL_PAGE_SIZE]
+        pool = {'id': POOL_ID, 'name': 'mock_pool', 'posts': [self._post_json(post) for post in posts]}
+        if catalog.pool_post_count:
+            pool['post_count'] = len(catalog.pool)
+        if catalog.pool_post_ids:
+            pool['post_ids'] = [post['id'] for post in catalog.pool]
+        body = json.dumps(pool).encode()
+        self._send_json(body)
+
+    def _file(self, name: str):
+        post = self.server.catalog.by_md5.get(name.split('.')[0])
+        if post is None:
+            self._send(404, b'')
+            return
+
+        if self.server.fail_file(post['id']):
+            self.server.count('errors')
+            self._send(503, b'', headers={'Retry-After': '0'})
+            return
+
+        self.server.count('files')
+        data = self.server.catalog.file_data(post['id'])
+        etag = '"{}"'.format(post['md5'])
+        start = 0
+        if 'Range' in self.headers and self.headers.get('If-Range') in (None, etag):
+            start = int(self.headers['Range'][len('bytes='):].split('-')[0])
+
+        self.server.count('file_bytes', len(data) - start)
+        self._send(206 if start else 200, data[start:], 'image/png', {'ETag': etag, 'Accept-Ranges': 'bytes'})
+
+
+class MockE621Server(ThreadingMixIn, HTTPServer):
+    """Threaded mock server.  latency is added to every request in seconds, bandwidth is per connection in bytes per
+       second (0 for unlimited) and error_rate is the fraction of requests answered with a 503.  failing_files maps
+       post ids to how many more requests for their file get a 503"""
+    daemon_threads = True
+
+    def __init__(self, catalog: MockCatalog, latency: float = 0, bandwidth: int = 0, error_rate: float = 0,
+                 port: int = 0):
+        super().__init__(('127.0.0.1', port), MockE621Handler)
+        self.catalog = catalog
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.failing_files = {}  # type: Dict[int, int]
+        self.counters = {'api': 0, 'not_modified': 0, 'files': 0, 'file_bytes': 0, 'errors': 0}
+        self._counter_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:{:d}'.format(self.server_port)
+
+    def count(self, name: str, value: int = 1):
+        with self._counter_lock:
+            self.counters[name] += value
+
+    def fail_file(self, post_id: int) -> bool:
+        with self._counter_lock:
+            if self.failing_files.get(post_id, 0) <= 0:
+                return False
+            self.failing_files[post_id] -= 1
+            return True
+
+    def reset_counters(self) -> Dict[str, int]:
+        with self._counter_lock:
+            counters = dict(self.counters)
+            for name in self.counters:
+                self.counters[name] = 0
+        return counters
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,137 @@
+"""End to end sync benchmark against a local mock e621 server
+
+Each configuration runs e621sync.py in a fresh process (so peak RSS is per run) against a clean download directory,
+and reports posts/sec, MB/sec, API calls per new post and peak RSS.  Results can be saved with --output and compared to
+an earlier run with --compare, e.g. before and after a change:
+
+    python benchmarks/run_benchmark.py --workers 1 4 16 --output before.json
+    python benchmarks/run_benchmark.py --workers 1 4 16 --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mockserver import MockCatalog, MockE621Server, POOL_ID  # noqa: E402
+
+E621SYNC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'e621sync.py')
+
+CONFIG_TEMPLATE = '''
+api_url = "{api_url}"
+max_workers = {workers}
+api_rate_limit = 0
+cdn_rate_limit = 0
+list_limit = {list_limit}
+minimum_score = -1
+state_file = "{state_file}"
+lock_file = "{directory}/e621sync.lock"
+
+[rules.posts]
+tags = [ "mock" ]
+download_directory = "{directory}/posts/"
+'''
+
+POOL_RULE_TEMPLATE = '''
+[rules.pool]
+tags = [ "pool:{pool_id}" ]
+download_directory = "{directory}/pool/"
+'''
+
+
+def run_sync(server: MockE621Server, workers: int, list_limit: int, with_pool: bool, extra_args: list) -> dict:
+    directory = tempfile.mkdtemp(prefix='e621sync_benchmark_')
+    try:
+        config_filename = os.path.join(directory, 'config.toml')
+        with open(config_filename, 'w') as f:
+            f.write(CONFIG_TEMPLATE.format(api_url=server.url, workers=workers, list_limit=list_limit,
+                                           state_file=os.path.join(directory, 'state.sqlite').replace('\\', '/'),
+                                           directory=directory.replace('\\', '/')))
+            if with_pool:
+                f.write(POOL_RULE_TEMPLATE.format(pool_id=POOL_ID, directory=directory.replace('\\', '/')))
+
+        server.reset_counters()
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, E621SYNC, '--config', config_filename] + extra_args,
+                                   stdout=subprocess.DEVNULL)
+        _, status, rusage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+        counters = server.reset_counters()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    # ru_maxrss is in KB on Linux, but bytes on macOS
+    peak_rss = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    files = counters['files']
+    return {'workers': workers, 'exit_status': status, 'seconds': round(elapsed, 3), 'files': files,
+            'api_calls': counters['api'], 'errors': counters['errors'],
+            'posts_per_second': round(files / elapsed, 2),
+            'mb_per_second': round(counters['file_bytes'] / elapsed / 1024 / 1024, 3),
+            'api_calls_per_new_post': round(counters['api'] / files, 4) if files else None,
+            'peak_rss_mb': round(peak_rss / 1024 / 1024, 1)}
+
+
+def print_results(results: list, previous: list = None):
+    columns = ('workers', 'seconds', 'files', 'posts_per_second', 'mb_per_second', 'api_calls_per_new_post',
+               'peak_rss_mb')
+    print('  '.join(columns))
+
+    previous_by_key = {result['workers']: result for result in (previous or [])}
+    for result in results:
+        print('  '.join(str(result[column]).rjust(len(column)) for column in columns))
+        before = previous_by_key.get(result['workers'])
+        if before is not None:
+            changes = []
+            for column in ('posts_per_second', 'mb_per_second', 'peak_rss_mb'):
+                if before[column]:
+                    changes.append('{} {:+.1%}'.format(column, result[column] / before[column] - 1))
+            print('    vs previous:  ' + ',  '.join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', help='Number of posts in the mock catalog (default: 2000)', type=int, default=2000)
+    parser.add_argument('--pool-size', help='Number of posts in the mock pool, 0 for no pool rule (default: 0)',
+                        type=int, default=0)
+    parser.add_argument('--file-size', help='Size of each file in bytes (default: 65536)', type=int, default=65536)
+    parser.add_argument('--list-limit', help='Posts per listing page (default: 320)', type=int, default=320)
+    parser.add_argument('--latency', help='Seconds added to every request (default: 0.02)', type=float, default=0.02)
+    parser.add_argument('--bandwidth', help='Bytes per second per connection, 0 for unlimited (default: 0)',
+                        type=int, default=0)
+    parser.add_argument('--error-rate', help='Fraction of requests that get a 503 (default: 0)', type=float,
+                        default=0)
+    parser.add_argument('--workers', help='max_workers settings to compare (default: 1 4 16)', type=int, nargs='+',
+                        default=[1, 4, 16])
+    parser.add_argument('--output', help='Save the results as JSON', metavar='FILE')
+    parser.add_argument('--compare', help='Compare with results saved by an earlier --output', metavar='FILE')
+    args, extra_args = parser.parse_known_args()
+
+    catalog = MockCatalog(args.posts, args.file_size, pool_size=args.pool_size)
+    server = MockE621Server(catalog, args.latency, args.bandwidth, args.error_rate).start()
+    print('Mock e621 on {} with {:d} posts of {:d} bytes, {:.0f}ms latency'.format(
+        server.url, args.posts, args.file_size, args.latency * 1000))
+
+    try:
+        results = [run_sync(server, workers, args.list_limit, args.pool_size > 0, extra_args)
+                   for workers in args.workers]
+    finally:
+        server.stop()
+
+    previous = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            previous = json.load(f)['results']
+
+    print_results(results, previous)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'arguments': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
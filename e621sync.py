@@ -1,33 +1,351 @@
+import os
 import sys
+import time
+import signal
 import argparse
-from typing import List
+import threading
+from contextlib import contextmanager
+from typing import List, Optional
 
 from e621sync.configuration import Configuration, ConfigurationException
 from e621sync.threadpool import ThreadPool
 from e621sync.rule import Rule
 from e621sync.downloadposts import DownloadPosts
 from e621sync.downloadpool import DownloadPool
+from e621sync.stateindex import StateIndex
+from e621sync.httpsession import HttpSession
+from e621sync.dedup import DownloadRegistry
+from e621sync.diskwriter import DiskWriter
+from e621sync.responsecache import ResponseCache
+from e621sync.metadatastore import MetadataStore
+from e621sync.plan import SyncPlan, PlannedDownloads, PlanException
+from e621sync.verify import verify_directories, relist_mark
+from e621sync.metrics import Metrics, Profiler
+from e621sync.lockfile import LockFile, LockFileException
 from e621sync.globalsettings import VERSION
 
 
-def sync(rules: List[Rule], max_workers: int):
+def make_pool(config: Configuration, metrics: Metrics, profiler: Profiler = None):
+    disk_writer = DiskWriter(config.disk_writers, config.disk_write_buffer * 1024 * 1024)
+    cache = None
+    if config.listing_cache is not None:
+        cache = ResponseCache(config.listing_cache, config.listing_cache_ttl, config.listing_cache_size * 1024 * 1024)
+
+    session = HttpSession(config.max_workers, config.api_rate_limit, config.cdn_rate_limit, metrics, config.api_url,
+                          cache)
+    return ThreadPool(max_workers=config.max_workers, session=session, metrics=metrics, profiler=profiler,
+                      max_queued_downloads=config.max_queued_downloads, disk_writer=disk_writer,
+                      min_workers=config.min_workers)
+
+
+def queue_rule(thread_pool, rule: Rule, state_index: StateIndex, incremental: bool, registry: DownloadRegistry,
+               plan: SyncPlan = None, metadata: MetadataStore = None) -> DownloadPosts:
+    if rule.get_pool_id() is not None:
+        return DownloadPool(thread_pool, rule, state_index, incremental, registry, plan, metadata)
+    return DownloadPosts(thread_pool, rule, state_index, incremental, registry, plan, metadata)
+
+
+@contextmanager
+def stop_on_signal(thread_pool, stopping: threading.Event = None):
+    """The first Ctrl-C (or SIGTERM) lets the running jobs finish and then stops, a second also cancels them"""
+    def handler(signum, frame):
+        if thread_pool.interrupted:
+            print('Cancelling running jobs')
+            thread_pool.cancel()
+        else:
+            print('Stopping once the running jobs finish, press Ctrl-C again to cancel them')
+            thread_pool.drain()
+        if stopping is not None:
+            stopping.set()
+
+    # signal handlers can only be set from the main thread
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    previous = {signum: signal.signal(signum, handler) for signum in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        yield
+    finally:
+        for signum, previous_handler in previous.items():
+            signal.signal(signum, previous_handler)
+
+
+def load_checkpoint(checkpoint_file: str = None) -> Optional[SyncPlan]:
+    if checkpoint_file is None or not os.path.exists(checkpoint_file):
+        return None
+    try:
+        checkpoint = SyncPlan.load(checkpoint_file)
+    except (OSError, ValueError, KeyError, PlanException) as e:
+        print('Ignoring checkpoint: {}'.format(e))
+        return None
+    print('Resuming {:d} downloads left unfinished by the last run'.format(checkpoint.download_count()))
+    return checkpoint
+
+
+def save_checkpoint(checkpoint_file: str, downloaders: List[DownloadPosts]):
+    """Save the downloads that were queued but didn't finish, so the next run starts with them"""
+    checkpoint = SyncPlan()
+    for downloader in downloaders:
+        downloader.checkpoint(checkpoint)
+    checkpoint.save(checkpoint_file)
+    print('Stopped early, saved {:d} unfinished downloads to {}'.format(checkpoint.download_count(), checkpoint_file))
+
+
+def print_starting(rules: List[Rule], max_workers: int):
     print('Starting e621sync {} with {:d} rules and {:d} threads'.format(VERSION, len(rules), max_workers))
 
-    with ThreadPool(max_workers=max_workers) as thread_pool:
+
+def sync(config: Configuration, metrics_file: str = None, prometheus_file: str = None, profile_file: str = None,
+         plan: SyncPlan = None, from_plan: SyncPlan = None):
+    """With plan, every rule is listed but nothing is downloaded, the posts that would be are added to the plan.  With
+       from_plan, the plan's downloads are run without listing.
+
+       If the sync is stopped early (Ctrl-C or SIGTERM) the unfinished downloads are saved to config.checkpoint_file,
+       and the next sync with the same checkpoint_file downloads them along with whatever it lists.  The metadata of
+       every post listed is kept in config.metadata_store, if set."""
+    rules = config.rules
+    metrics = Metrics()
+    profiler = Profiler() if profile_file is not None else None
+
+    print_starting(rules, config.max_workers)
+    pool = make_pool(config, metrics, profiler)
+
+    state_index = StateIndex(config.state_file if config.state_file is not None else ':memory:')
+    registry = DownloadRegistry(state_index, config.content_store)
+    metadata = MetadataStore(config.metadata_store) if config.metadata_store is not None else None
+    checkpoint_file = config.checkpoint_file if plan is None else None
+    checkpoint = load_checkpoint(checkpoint_file)
+
+    downloaders = []  # type: List[DownloadPosts]
+    with stop_on_signal(pool), pool as thread_pool:
         for rule in rules:
-            if rule.get_pool_id() is not None:
-                DownloadPool(thread_pool, rule)
+            if from_plan is not None:
+                downloaders.append(PlannedDownloads(thread_pool, rule, state_index, from_plan.downloads(rule.name),
+                                                    registry))
             else:
-                DownloadPosts(thread_pool, rule)
+                downloaders.append(queue_rule(thread_pool, rule, state_index, config.incremental, registry, plan,
+                                              metadata))
+
+            if checkpoint is not None and checkpoint.downloads(rule.name):
+                downloaders.append(PlannedDownloads(thread_pool, rule, state_index, checkpoint.downloads(rule.name),
+                                                    registry))
+
+    # an interrupted sync leaves downloads unfinished, so the marks stay where they were
+    if not thread_pool.interrupted:
+        for downloader in downloaders:
+            downloader.save_high_water_mark()
+
+    if checkpoint_file is not None:
+        if thread_pool.interrupted:
+            save_checkpoint(checkpoint_file, downloaders)
+        elif checkpoint is not None:
+            os.remove(checkpoint_file)
+
+    print(thread_pool.session)
+    if thread_pool.session.cache is not None:
+        print(thread_pool.session.cache)
+    print('Linked {:d} files already downloaded by other rules'.format(registry.files_linked))
+    thread_pool.session.close()
+    state_index.close()
+    if metadata is not None:
+        metadata.close()
+
+    metrics.print_summary()
+    if metrics_file is not None:
+        metrics.write_json(metrics_file)
+    if prometheus_file is not None:
+        metrics.write_prometheus(prometheus_file)
+    if profiler is not None:
+        profiler.write(profile_file)
 
     print('Done')
+    return metrics.summary()
+
+
+def daemon(config: Configuration, metrics_file: str = None, prometheus_file: str = None, max_polls: int = None):
+    """Keep running, and sync each rule incrementally every rule.poll_interval seconds.  The pool, its connections and
+       the state index are kept between polls, so a rule with nothing new costs a single listing request.  Stops after
+       max_polls rounds of polling if set, otherwise on Ctrl-C or SIGTERM (saving unfinished downloads to
+       config.checkpoint_file, like sync)"""
+    rules = config.rules
+    checkpoint_file = config.checkpoint_file
+    metrics = Metrics()
+
+    print_starting(rules, config.max_workers)
+    thread_pool = make_pool(config, metrics)
+    state_index = StateIndex(config.state_file if config.state_file is not None else ':memory:')
+    registry = DownloadRegistry(state_index, config.content_store)
+    metadata = MetadataStore(config.metadata_store) if config.metadata_store is not None else None
+    checkpoint = load_checkpoint(checkpoint_file)
+
+    next_poll = {rule.name: time.monotonic() for rule in rules}
+    polls = 0
+    stopping = threading.Event()
+    try:
+        thread_pool.start()
+        with stop_on_signal(thread_pool, stopping):
+            while max_polls is None or polls < max_polls:
+                downloaders = []  # type: List[DownloadPosts]
+                now = time.monotonic()
+                for rule in rules:
+                    if next_poll[rule.name] <= now:
+                        next_poll[rule.name] = now + rule.poll_interval
+                        downloaders.append(queue_rule(thread_pool, rule, state_index, True, registry,
+                                                      metadata=metadata))
+                    if checkpoint is not None and checkpoint.downloads(rule.name):
+                        downloaders.append(PlannedDownloads(thread_pool, rule, state_index,
+                                                            checkpoint.downloads(rule.name), registry))
+
+                # rules that come due while this poll is still downloading wait for the next round
+                thread_pool.wait()
+                if thread_pool.interrupted:
+                    if checkpoint_file is not None:
+                        save_checkpoint(checkpoint_file, downloaders)
+                    break
+                if checkpoint is not None:
+                    os.remove(checkpoint_file)
+                    checkpoint = None
+
+                for downloader in downloaders:
+                    downloader.save_high_water_mark()
+                registry.clear_failures()
+                state_index.commit()
+                if metadata is not None:
+                    metadata.commit()
+                if metrics_file is not None:
+                    metrics.write_json(metrics_file)
+                if prometheus_file is not None:
+                    metrics.write_prometheus(prometheus_file)
+
+                polls += 1
+                if max_polls is None or polls < max_polls:
+                    stopping.wait(max(0.0, min(next_poll.values()) - time.monotonic()))
+                if stopping.is_set():
+                    break
+    finally:
+        thread_pool.close()
+        thread_pool.session.close()
+        state_index.close()
+        if metadata is not None:
+            metadata.close()
+
+    metrics.print_summary()
+    print('Done')
+    return metrics.summary()
+
+
+def rule_for_file(rules: List[Rule], filename: str) -> Optional[Rule]:
+    """The rule whose download_directory filename is in (the innermost, if they're nested)"""
+    path = os.path.abspath(filename)
+    matching = [rule for rule in rules
+                if path.startswith(os.path.join(os.path.abspath(rule.download_directory), ''))]
+    return max(matching, key=lambda rule: len(os.path.abspath(rule.download_directory)), default=None)
+
+
+def forget_download(rules: List[Rule], state_index: StateIndex, filename: str):
+    """Remove filename from the index, and move its rule's high water mark back to it so the next sync downloads it
+       again even if it's incremental"""
+    state_index.remove_download(filename)
+    rule = rule_for_file(rules, filename)
+    mark = relist_mark(filename, rule.get_pool_id() is not None) if rule is not None else None
+    if mark is not None:
+        state_index.lower_high_water_mark(rule.name, mark)
+
+
+def verify(rules: List[Rule], state_file: str = None, content_store: str = None, repair: bool = False):
+    """Check the md5 of every downloaded file.  With repair, bad files are deleted and forgotten, so the next sync
+       downloads them again.  Files in the index that are no longer on disk are always forgotten, since there is
+       nothing left to repair"""
+    directories = [rule.download_directory for rule in rules]
+    if content_store is not None:
+        directories.append(content_store)
+
+    print('Verifying e621sync {} downloads in {:d} directories'.format(VERSION, len(directories)))
+
+    state_index = StateIndex(state_file if state_file is not None else ':memory:')
+    bad_files = 0
+    for filename in state_index.get_all_filenames():
+        if not os.path.exists(filename):
+            bad_files += 1
+            print('Missing file {:s}'.format(filename))
+            forget_download(rules, state_index, filename)
+
+    for filename, expected, actual in verify_directories(directories):
+        bad_files += 1
+        print('Bad file {:s}  expected md5 {}  got {}'.format(filename, expected, actual or 'unreadable'))
+        if repair:
+            os.remove(filename)
+            forget_download(rules, state_index, filename)
+    state_index.close()
+
+    print('Found {:d} bad files{}'.format(bad_files, ', removed for re-download' if repair and bad_files else ''))
+    return bad_files
+
+
+def query(tags: List[str], metadata_store: str, state_file: str = None) -> List[int]:
+    """Print the downloaded files of every post in metadata_store with all of tags (and none of the tags starting
+       with -), newest first.  Posts that haven't been downloaded are printed as their id.  This only reads, so it
+       doesn't need the lock and can run while a sync is going"""
+    metadata = MetadataStore(metadata_store)
+    state_index = StateIndex(state_file if state_file is not None else ':memory:')
+    post_ids = metadata.query(tags)
+    for post_id in post_ids:
+        filenames = state_index.get_filenames(post_id)
+        for filename in filenames or [str(post_id)]:
+            print(filename)
+    state_index.close()
+    metadata.close()
+    return post_ids
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--config', help='Specify a configuration file to load (default: config.toml)')
+    parser.add_argument('--repair', help='verify: delete bad files so the next sync downloads them again',
+                        action='store_true')
+    parser.add_argument('--metrics', help='Write a JSON summary of throughput, latency and queue depth to this file',
+                        metavar='FILE')
+    parser.add_argument('--prometheus', help='Write the metrics in Prometheus text format to this file', metavar='FILE')
+    parser.add_argument('--profile', help='Profile every job with cProfile and write the merged stats to this file',
+                        metavar='FILE')
+    parser.add_argument('--daemon', help='Keep running and check each rule for new posts every poll_interval seconds',
+                        action='store_true')
+    parser.add_argument('--plan', help='List every rule and report what would be downloaded, without downloading',
+                        action='store_true')
+    parser.add_argument('--plan-file', help='--plan: save the plan to this file, or without --plan: download the '
+                                            'posts in a saved plan instead of listing', metavar='FILE')
+    sync_mode = parser.add_mutually_exclusive_group()
+    sync_mode.add_argument('--incremental', help='Stop listing each rule once it reaches posts seen by the last sync',
+                           action='store_true')
+    sync_mode.add_argument('--full', help='Re-list every rule from the start, ignoring the last sync',
+                           action='store_true')
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--config', help='Specify a configuration file to load (default: config.toml)',
-                        default='config.toml')
-    command_line_args = parser.parse_args()
+    add_arguments(parser)
+    parser.set_defaults(config='config.toml')
+
+    # the options can also go after the command.  SUPPRESS keeps the subcommand from overwriting any given before it
+    commands = parser.add_subparsers(dest='command', metavar='command', help='(default: sync)')
+    add_arguments(commands.add_parser('sync', help='download new posts', argument_default=argparse.SUPPRESS))
+    add_arguments(commands.add_parser('verify', help='check the md5 of downloaded files',
+                                      argument_default=argparse.SUPPRESS))
+    # without -h, a -hairy typed out of habit gets the --not hint instead of being taken for -h airy
+    query_parser = commands.add_parser('query', help='search metadata_store', argument_default=argparse.SUPPRESS,
+                                       add_help=False)
+    query_parser.add_argument('--help', help='show this help message and exit', action='help')
+    query_parser.add_argument('--config', help='Specify a configuration file to load (default: config.toml)')
+    query_parser.add_argument('tags', help='tags the posts must have', nargs='*', default=[])
+    query_parser.add_argument('--not', help='a tag the posts must not have, can be given more than once',
+                              action='append', default=[], metavar='TAG', dest='excluded_tags')
+    # argparse stops filling a positional at the first option, so tags after a --not come back unrecognised
+    command_line_args, extra_args = parser.parse_known_args()
+    command = command_line_args.command or 'sync'
+    if command == 'query' and any(arg.startswith('-') for arg in extra_args):
+        parser.error('unrecognized arguments: {}  (exclude tags with --not TAG)'.format(' '.join(extra_args)))
+    if command != 'query' and extra_args:
+        parser.error('unrecognized arguments: {}'.format(' '.join(extra_args)))
 
     try:
         config = Configuration().load(command_line_args.config)
@@ -39,4 +357,53 @@ if __name__ == '__main__':
         print(e)
         sys.exit(1)
 
-    sync(config.rules, config.max_workers)
+    # searching only reads the metadata, so it can run alongside a sync
+    if command == 'query':
+        if config.metadata_store is None:
+            print('Set metadata_store in the config file to keep post metadata for searching')
+            sys.exit(1)
+        excluded_tags = ['-' + tag for tag in command_line_args.excluded_tags]
+        query(command_line_args.tags + extra_args + excluded_tags, config.metadata_store, config.state_file)
+        sys.exit(0)
+
+    lock_file = LockFile(config.lock_file) if config.lock_file else None
+    try:
+        if lock_file is not None:
+            lock_file.acquire()
+    except LockFileException as e:
+        print(e)
+        sys.exit(1)
+
+    try:
+        if command == 'verify':
+            bad_files = verify(config.rules, config.state_file, config.content_store, command_line_args.repair)
+            sys.exit(1 if bad_files and not command_line_args.repair else 0)
+
+        if command_line_args.daemon:
+            daemon(config, command_line_args.metrics, command_line_args.prometheus)
+            sys.exit(0)
+
+        if command_line_args.incremental:
+            config.incremental = True
+        elif command_line_args.full:
+            config.incremental = False
+
+        plan = SyncPlan() if command_line_args.plan else None
+        from_plan = None
+        if command_line_args.plan_file is not None and plan is None:
+            try:
+                from_plan = SyncPlan.load(command_line_args.plan_file)
+            except (OSError, ValueError, PlanException) as e:
+                print('Unable to load plan file: {}'.format(e))
+                sys.exit(1)
+
+        sync(config, command_line_args.metrics, command_line_args.prometheus, command_line_args.profile, plan,
+             from_plan)
+
+        if plan is not None:
+            plan.print_summary()
+            if command_line_args.plan_file is not None:
+                plan.save(command_line_args.plan_file)
+    finally:
+        if lock_file is not None:
+            lock_file.release()
@@ -1,7 +1,8 @@
 import toml
-from typing import List
+from typing import List, Optional
 
 from .rule import Rule
+from .globalsettings import API_URL
 
 
 class ConfigurationException(Exception):
@@ -12,6 +13,22 @@ class Configuration:
     def __init__(self):
         self._config = None
         self.max_workers = 4
+        self.min_workers = None  # type: Optional[int]
+        self.state_file = None  # type: Optional[str]
+        self.incremental = False
+        self.content_store = None  # type: Optional[str]
+        self.api_url = API_URL
+        self.max_queued_downloads = 1000
+        self.api_rate_limit = 2.0
+        self.cdn_rate_limit = 10.0
+        self.lock_file = 'e621sync.lock'  # type: Optional[str]
+        self.disk_writers = 1
+        self.disk_write_buffer = 64
+        self.listing_cache = None  # type: Optional[str]
+        self.listing_cache_ttl = 0
+        self.listing_cache_size = 100
+        self.checkpoint_file = 'e621sync.checkpoint.json'  # type: Optional[str]
+        self.metadata_store = None  # type: Optional[str]
         self.rules = []  # type: List[Rule]
 
     def load(self, filename: str):
@@ -25,12 +42,36 @@ class Configuration:
         except toml.TomlDecodeError as e:
             raise ConfigurationException(e)
 
-        self.max_workers = self._parse_int(self._config, 'max_workers', 1, 16, self.max_workers)
+        self.max_workers = self._parse_int(self._config, 'max_workers', 1, 128, self.max_workers)
+        self.min_workers = self._parse_int(self._config, 'min_workers', 1, self.max_workers, self.min_workers)
+        self.max_queued_downloads = self._parse_int(self._config, 'max_queued_downloads', 10, 1000000,
+                                                    self.max_queued_downloads)
+        self.api_rate_limit = self._parse_number(self._config, 'api_rate_limit', 0, 100, self.api_rate_limit)
+        self.cdn_rate_limit = self._parse_number(self._config, 'cdn_rate_limit', 0, 1000, self.cdn_rate_limit)
+        self.state_file = self._parse_string(self._config, 'state_file', self.state_file)
+        self.content_store = self._parse_string(self._config, 'content_store', self.content_store)
+        self.api_url = self._parse_string(self._config, 'api_url', self.api_url)
+        self.incremental = self._parse_bool(self._config, 'incremental', self.incremental)
+        self.lock_file = self._parse_string(self._config, 'lock_file', self.lock_file)
+        self.disk_writers = self._parse_int(self._config, 'disk_writers', 1, 16, self.disk_writers)
+        self.disk_write_buffer = self._parse_int(self._config, 'disk_write_buffer', 1, 4096, self.disk_write_buffer)
+        self.listing_cache = self._parse_string(self._config, 'listing_cache', self.listing_cache)
+        self.checkpoint_file = self._parse_string(self._config, 'checkpoint_file', self.checkpoint_file)
+        self.metadata_store = self._parse_string(self._config, 'metadata_store', self.metadata_store)
+        self.listing_cache_ttl = self._parse_int(self._config, 'listing_cache_ttl', 0, 30 * 24 * 60 * 60,
+                                                 self.listing_cache_ttl)
+        self.listing_cache_size = self._parse_int(self._config, 'listing_cache_size', 1, 100000,
+                                                  self.listing_cache_size)
 
         list_limit = self._parse_int(self._config, 'list_limit', 10, 320, 100)
         common_tags = self._parse_list_of_strings(self._config, 'common_tags', [])
         blacklist_tags = self._parse_list_of_strings(self._config, 'blacklist_tags', [])
         minimum_score = self._parse_int(self._config, 'minimum_score', -100000, 100000, 0)
+        listing_lookahead = self._parse_int(self._config, 'listing_lookahead', 0, 16, 2)
+        poll_interval = self._parse_int(self._config, 'poll_interval', 10, 7 * 24 * 60 * 60, 600)
+        ratings = self._parse_ratings(self._config, [])
+        file_extensions = self._parse_list_of_strings(self._config, 'file_ext', [])
+        max_file_size = self._parse_int(self._config, 'max_file_size', 0, 2 ** 40, 0)
 
         self.rules = []
         for rule_name in self._config['rules']:
@@ -46,6 +87,14 @@ class Configuration:
             rule.minimum_score = self._parse_int(rule_config, 'minimum_score', -100000, 100000, minimum_score)
             rule.download_directory = self._parse_string(rule_config, 'download_directory', None)
             rule.list_limit = self._parse_int(rule_config, 'list_limit', 10, 320, list_limit)
+            rule.listing_lookahead = self._parse_int(rule_config, 'listing_lookahead', 0, 16, listing_lookahead)
+            rule.priority = self._parse_int(rule_config, 'priority', 1, 100, 1)
+            rule.max_concurrent = self._parse_int(rule_config, 'max_concurrent', 0, 256, 0)
+            rule.poll_interval = self._parse_int(rule_config, 'poll_interval', 10, 7 * 24 * 60 * 60, poll_interval)
+            rule.local_tags = self._parse_list_of_strings(rule_config, 'local_tags', [])
+            rule.ratings = self._parse_ratings(rule_config, ratings)
+            rule.file_extensions = self._parse_list_of_strings(rule_config, 'file_ext', file_extensions)
+            rule.max_file_size = self._parse_int(rule_config, 'max_file_size', 0, 2 ** 40, max_file_size)
 
             # Sets are not ordered by id like general searches.  To make sure all items are found, need to order the
             # results by id (highest to lowest).  Check if the user used a 'set:' with an 'order:-id' and fix it.
@@ -53,8 +102,12 @@ class Configuration:
             if rule.has_set_and_needs_order_tag():
                 rule.tags.append('order:-id')
 
-            if len(rule.tags) < 6 and not rule.has_score_tag():
-                rule.tags.append('score:>{}'.format(rule.minimum_score))
+            # The minimum score is always checked client side (unless the rule has its own score: tag), but if there's
+            # room also send it to the server so fewer posts are listed
+            if not rule.has_score_tag():
+                rule.check_minimum_score = True
+                if len(rule.tags) < 6:
+                    rule.tags.append('score:>{}'.format(rule.minimum_score))
 
             # TODO: should we try and apply some of the blacklist tags here too if < 6 tags?
 
@@ -72,6 +125,16 @@ class Configuration:
 
             self.rules.append(rule)
 
+    @staticmethod
+    def _parse_ratings(config, default: List[str] = None):
+        ratings = Configuration._parse_list_of_strings(config, 'ratings', default)
+
+        for rating in ratings:
+            if rating not in ('safe', 'questionable', 'explicit', 's', 'q', 'e'):
+                raise ConfigurationException("ratings must be safe, questionable or explicit: {} is not".format(rating))
+
+        return ratings
+
     @staticmethod
     def _parse_int(config, name: str, minimum: int, maximum: int, default: int = None):
         if name not in config:
@@ -84,6 +147,29 @@ class Configuration:
 
         return config[name]
 
+    @staticmethod
+    def _parse_number(config, name: str, minimum: float, maximum: float, default: float = None):
+        """Like _parse_int, but also allows floats"""
+        if name not in config:
+            return default
+
+        if (type(config[name]) not in (int, float)) or \
+                (config[name] > maximum) or \
+                (config[name] < minimum):
+            raise ConfigurationException("{} most be a number between {} and {}".format(name, minimum, maximum))
+
+        return config[name]
+
+    @staticmethod
+    def _parse_bool(config, name: str, default: bool = None):
+        if name not in config:
+            return default
+
+        if type(config[name]) is not bool:
+            raise ConfigurationException("{} most be true or false".format(name))
+
+        return config[name]
+
     @staticmethod
     def _parse_string(config, name: str, default: str = None):
         if name not in config:
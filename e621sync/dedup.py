@@ -0,0 +1,136 @@
+import os
+import shutil
+from threading import Lock
+from typing import Dict, List, Optional, Tuple, Set
+
+from .stateindex import StateIndex
+from .globalsettings import PARTIAL_DOWNLOAD_SUFFIX
+
+
+def link_file(source: str, target: str):
+    """Hardlink source to target, falling back to a copy when they're on different file systems (or links aren't
+       supported at all)"""
+    directory = os.path.dirname(target)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        pass
+    except OSError:
+        partial_target = target + PARTIAL_DOWNLOAD_SUFFIX
+        shutil.copy2(source, partial_target)
+        os.replace(partial_target, target)
+
+
+class DownloadRegistry:
+    """Run wide record of which files (by md5) are downloaded or being downloaded, so when several rules match the
+       same post it is only downloaded once and the other rules get a hardlink to it
+
+       With a content_store directory, every file is downloaded once to <content_store>/<ab>/<md5>.<ext> and each
+       rule's download_directory becomes a tree of links into the store."""
+
+    def __init__(self, state_index: StateIndex, content_store: str = None):
+        self.state_index = state_index
+        self.content_store = content_store
+        self.files_linked = 0
+        self._lock = Lock()
+        # md5 -> files (filename, post_id, rule_name) waiting for the download to finish
+        self._in_flight = {}  # type: Dict[str, List[Tuple[str, int, str]]]
+        # every filename that is being downloaded or waiting on a download, and the file (filename, post_id, rule_name)
+        # each md5 is downloading to
+        self._claimed = set()
+        self._downloading = {}  # type: Dict[str, Tuple[str, int, str]]
+        # rule name -> ids of the posts whose files couldn't be downloaded, see failed_posts()
+        self._failed = {}  # type: Dict[str, Set[int]]
+
+    def store_filename(self, md5: str, file_ext: str) -> str:
+        return os.path.join(self.content_store, md5[0:2], '{}.{}'.format(md5, file_ext))
+
+    def _existing_file(self, md5: str, file_ext: str) -> Optional[str]:
+        if self.content_store is not None:
+            source = self.store_filename(md5, file_ext)
+        else:
+            source = self.state_index.find_by_md5(md5)
+        if source is not None and os.path.exists(source):
+            return source
+        return None
+
+    def is_downloaded(self, md5: str, file_ext: str) -> bool:
+        """Is there already a copy of this file that could be linked to"""
+        return self._existing_file(md5, file_ext) is not None
+
+    def claim(self, md5: str, file_ext: str, filename: str, post_id: int, rule_name: str) -> Optional[str]:
+        """Returns the filename the caller should download to.  Or None if filename has been linked to an existing
+           download, or will be linked once an in flight download of the same file finishes"""
+        with self._lock:
+            # the same file queued twice, e.g. by a listing and a checkpoint being resumed
+            if filename in self._claimed:
+                return None
+
+            if md5 in self._in_flight:
+                self._in_flight[md5].append((filename, post_id, rule_name))
+                self._claimed.add(filename)
+                return None
+
+            source = self._existing_file(md5, file_ext)
+            if source is None:
+                self._claimed.add(filename)
+                self._downloading[md5] = (filename, post_id, rule_name)
+                if self.content_store is None:
+                    self._in_flight[md5] = []
+                    return filename
+                self._in_flight[md5] = [(filename, post_id, rule_name)]
+                return self.store_filename(md5, file_ext)
+
+        self._link(source, md5, filename, post_id, rule_name)
+        return None
+
+    def complete(self, md5: str, downloaded_filename: str):
+        """The file has been downloaded, so link it to everything that was waiting for it"""
+        with self._lock:
+            waiting = self._in_flight.pop(md5, [])
+            self._unclaim(md5, waiting)
+
+        for filename, post_id, rule_name in waiting:
+            self._link(downloaded_filename, md5, filename, post_id, rule_name)
+
+    def release(self, md5: str):
+        """The download failed for good.  Anything waiting on it will be picked up by the next run, and is counted as
+           failed for its rule"""
+        with self._lock:
+            waiting = self._in_flight.pop(md5, [])
+            failed = waiting + ([self._downloading[md5]] if md5 in self._downloading else [])
+            for _, post_id, rule_name in failed:
+                self._failed.setdefault(rule_name, set()).add(post_id)
+            self._unclaim(md5, waiting)
+
+    def _unclaim(self, md5: str, waiting: List[Tuple[str, int, str]]):
+        downloading = self._downloading.pop(md5, None)
+        if downloading is not None:
+            self._claimed.discard(downloading[0])
+        for filename, _, _ in waiting:
+            self._claimed.discard(filename)
+
+    def failed_posts(self, rule_name: str) -> Set[int]:
+        """The rule's posts whose files weren't downloaded (or linked) because the download failed, since the last
+           clear_failures()"""
+        with self._lock:
+            return set(self._failed.get(rule_name, ()))
+
+    def clear_failures(self):
+        with self._lock:
+            self._failed = {}
+
+    def waiting(self, md5: str) -> List[Tuple[str, int, str]]:
+        """The files (filename, post_id, rule_name) that will be linked once md5 is downloaded"""
+        with self._lock:
+            return list(self._in_flight.get(md5, []))
+
+    def _link(self, source: str, md5: str, filename: str, post_id: int, rule_name: str):
+        link_file(source, filename)
+        self.state_index.add_download(filename, post_id, md5, rule_name)
+        with self._lock:
+            self.files_linked += 1
+        print('<{}>  Linked {:s}'.format(rule_name, filename))
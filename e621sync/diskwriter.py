@@ -0,0 +1,159 @@
+import os
+import itertools
+from queue import Queue
+from threading import Thread, Lock
+from concurrent.futures import Future
+from typing import Optional
+
+from .globalsettings import DOWNLOAD_CHUNK_SIZE
+
+
+class WriteHandle:
+    """A file being written by a DiskWriter.  If any write fails the error is kept here, and raised to the downloader
+       by its next write() or close()"""
+    __slots__ = ('writer', 'filename', 'file', 'preallocated', 'error')
+
+    def __init__(self, writer: 'WriterThread', filename: str):
+        self.writer = writer
+        self.filename = filename
+        self.file = None
+        self.preallocated = False
+        self.error = None  # type: Optional[BaseException]
+
+
+class WriterThread(Thread):
+    """Runs the disk operations for its share of the open files in order, from a bounded queue
+
+       Each file is fsynced as soon as its close comes off the queue.  The download waiting on it only waits for its
+       own data, never for other streams still being written by the same thread"""
+
+    def __init__(self, max_queued_chunks: int, directories: 'DirectoryCache'):
+        super().__init__()
+        self.daemon = True
+        self.queue = Queue(max(1, max_queued_chunks))
+        self.directories = directories
+
+    def run(self):
+        while True:
+            operation = self.queue.get()
+            if operation is None:
+                return
+
+            fun, handle, args = operation
+            if handle.error is None or fun is WriterThread._close:
+                try:
+                    fun(self, handle, *args)
+                except Exception as e:
+                    handle.error = e
+
+    def _open(self, handle: WriteHandle, append: bool, size: Optional[int]):
+        self.directories.make(os.path.dirname(handle.filename))
+        if append and os.path.exists(handle.filename):
+            handle.file = open(handle.filename, 'r+b')
+            handle.file.seek(0, os.SEEK_END)
+        else:
+            handle.file = open(handle.filename, 'wb')
+
+        if size and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(handle.file.fileno(), handle.file.tell(), size)
+                handle.preallocated = True
+            except OSError:
+                # not supported by every filesystem, and only an optimisation
+                pass
+
+    def _write(self, handle: WriteHandle, data: bytes):
+        handle.file.write(data)
+
+    def _close(self, handle: WriteHandle, done: Future):
+        if handle.file is None:
+            done.set_exception(handle.error or OSError('{}: never opened'.format(handle.filename)))
+            return
+
+        try:
+            # a transfer that stopped early must not leave preallocated space on the end, or a resume would start from
+            # the wrong offset
+            if handle.preallocated:
+                handle.file.truncate(handle.file.tell())
+            handle.file.flush()
+            if handle.error is None:
+                os.fsync(handle.file.fileno())
+        except Exception as e:
+            handle.error = handle.error or e
+        finally:
+            handle.file.close()
+
+        if handle.error is not None:
+            done.set_exception(handle.error)
+        else:
+            done.set_result(handle.filename)
+
+
+class DirectoryCache:
+    """Remembers which directories already exist, so each one is only checked (and created) once per run"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._directories = set()
+
+    def make(self, directory: str):
+        if not directory or directory in self._directories:
+            return
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            self._directories.add(directory)
+
+
+class DiskWriter:
+    """Writes downloads to disk on separate threads, so the network workers only hash and hand over each chunk
+
+       Each open file is assigned to one writer thread, which keeps its writes in order.  The queues are bounded by
+       buffer_size bytes in total, so if the disk can't keep up the downloads slow down rather than filling memory."""
+
+    def __init__(self, writers: int = 1, buffer_size: int = 64 * 1024 * 1024):
+        self.directories = DirectoryCache()
+        max_queued_chunks = buffer_size // DOWNLOAD_CHUNK_SIZE // max(1, writers)
+        self.threads = [WriterThread(max_queued_chunks, self.directories) for _ in range(0, max(1, writers))]
+        self._next_thread = itertools.cycle(self.threads)
+        self._lock = Lock()
+        self._started = False
+
+    def _start(self):
+        with self._lock:
+            if not self._started:
+                self._started = True
+                [thread.start() for thread in self.threads]
+
+    def open(self, filename: str, append: bool = False, size: int = None) -> WriteHandle:
+        """Start writing filename, or add to the end of it with append.  If size is known, that many bytes are
+           preallocated so the file isn't fragmented by other downloads being written at the same time"""
+        self._start()
+        with self._lock:
+            thread = next(self._next_thread)
+        handle = WriteHandle(thread, filename)
+        thread.queue.put((WriterThread._open, handle, (append, size)))
+        return handle
+
+    @staticmethod
+    def write(handle: WriteHandle, data: bytes):
+        """Blocks only while the writer's queue is full"""
+        if handle.error is not None:
+            raise handle.error
+        handle.writer.queue.put((WriterThread._write, handle, (data,)))
+
+    @staticmethod
+    def close(handle: WriteHandle) -> Future:
+        """The future completes once everything written is on disk (fsynced), or raises the first write error"""
+        done = Future()
+        handle.writer.queue.put((WriterThread._close, handle, (done,)))
+        return done
+
+    def stop(self):
+        """Finish every queued write and stop the writer threads.  Nothing can be written afterwards"""
+        with self._lock:
+            started = self._started
+        if started:
+            for thread in self.threads:
+                thread.queue.put(None)
+            for thread in self.threads:
+                thread.join()
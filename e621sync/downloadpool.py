@@ -1,27 +1,136 @@
+from typing import Optional, Dict
+
 from .downloadposts import DownloadPosts
 from .threadpool import HighPriorityJob
 
 
 class DownloadPool(DownloadPosts):
+    # number of posts returned on each pool page, if it can't be worked out from the first page
+    POSTS_PER_PAGE = 24
+
+    def __init__(self, *args, **kwargs):
+        self.posts_seen = 0
+        self.posts_per_page = self.POSTS_PER_PAGE
+        self.positions = {}  # type: Dict[int, int]
+        # post id -> position of every post processed, to find where the first failed download is
+        self._processed_positions = {}  # type: Dict[int, int]
+        super().__init__(*args, **kwargs)
+
     def get_listing(self, page_num: int = None):
         pool_vars = {'id': str(self.rule.get_pool_id())}
 
         if page_num is not None:
             pool_vars['page'] = str(page_num)
 
-        return self.get_json('https://e621.net/pool/show.json', pool_vars)
+        return self.get_json(self.thread_pool.session.api_url + '/pool/show.json', pool_vars)
+
+    def high_water_mark(self) -> Optional[int]:
+        """For pools the mark is the number of posts that have been synced, not a post id.  It stops at the first post
+           whose download failed"""
+        failed = self.registry.failed_posts(self.rule.name)
+        with self._lock:
+            return min([self.posts_seen] + [self._processed_positions[post_id] for post_id in failed
+                                            if post_id in self._processed_positions])
+
+    def process_rule(self):
+        """Fetch the first page to find out how big the pool is, then queue every other page that's needed at once.
+           Pool pages don't depend on each other, so unlike post listings there's no need to walk them in order"""
+        first_page = self.get_listing(1)
+        posts = first_page['posts']
+
+        # Newer API responses list every post id in order, otherwise positions come from the size of the first page
+        post_count = first_page.get('post_count')
+        if 'post_ids' in first_page:
+            self.positions = {post_id: index for index, post_id in enumerate(first_page['post_ids'])}
+            if post_count is None:
+                post_count = len(first_page['post_ids'])
+        if post_count is None:
+            self._page_sequentially(posts)
+            return
+
+        if posts and len(posts) < post_count:
+            self.posts_per_page = len(posts)
+        page_count = max(1, -(-post_count // self.posts_per_page))
+
+        # In incremental mode skip straight to the first page that can contain posts added since the last sync, or
+        # the whole pool if nothing has been added
+        first_page_num = 1
+        if self.previous_high_water_mark is not None:
+            if self.previous_high_water_mark >= post_count:
+                first_page_num = page_count + 1
+            else:
+                first_page_num += self.previous_high_water_mark // self.posts_per_page
+        page_nums = range(first_page_num, page_count + 1)
+
+        with self._lock:
+            self.posts_seen = min(post_count, (first_page_num - 1) * self.posts_per_page)
+            self._listing_done = True
+            self._pages_in_progress = len(page_nums)
 
-    def process_rule(self, page_num: int = 1):
-        items = self.get_listing(page_num)
-        self.items_found += len(items)
+        if not page_nums:
+            self.finish_rule()
+            return
 
-        for index, item in enumerate(items['posts']):
+        for num in page_nums:
+            if num != 1:
+                self.thread_pool.add_job(HighPriorityJob(self._fetch_page_job, num), self.rule.name)
+        if page_nums[0] == 1:
+            self._process_page_job((1, posts))
 
-            self.queue_download(item['file_url'], '{:04d}_{:d}_{}.{}'.format(index + ((page_num-1)*24), item['id'],
-                                                                             item['md5'], item['file_ext']))
+    def _page_sequentially(self, first_page_posts):
+        """Without a post_count there's no telling how many pages there are, so fetch them one after another until a
+           short (or empty) page"""
+        if first_page_posts:
+            self.posts_per_page = len(first_page_posts)
 
-        # found new items on this page, so try the next
-        if len(items['posts']) > 0:
-            self.thread_pool.add_job(HighPriorityJob(self.process_rule, page_num + 1))
+        first_page_num = 1
+        if self.previous_high_water_mark is not None:
+            first_page_num += self.previous_high_water_mark // self.posts_per_page
+
+        with self._lock:
+            self.posts_seen = (first_page_num - 1) * self.posts_per_page
+            self._pages_in_progress = 1
+
+        if first_page_num == 1:
+            self._sequential_page(1, first_page_posts)
         else:
-            self.print_rule_summary()
\ No newline at end of file
+            self.thread_pool.add_job(HighPriorityJob(self._fetch_sequential_page_job, first_page_num), self.rule.name)
+
+    def _sequential_page(self, page_num: int, posts):
+        """Queue the next page if this one was full, then process this one"""
+        with self._lock:
+            more = len(posts) >= self.posts_per_page > 0
+            if more:
+                self._pages_in_progress += 1
+            else:
+                self._listing_done = True
+
+        if more:
+            self.thread_pool.add_job(HighPriorityJob(self._fetch_sequential_page_job, page_num + 1), self.rule.name)
+        self._process_page_job((page_num, posts))
+
+    def _fetch_sequential_page_job(self, page_num: int):
+        self._sequential_page(page_num, self.get_listing(page_num)['posts'])
+
+    def _fetch_page_job(self, page_num: int):
+        self._process_page_job((page_num, self.get_listing(page_num)['posts']))
+
+    def position(self, page_num: int, index: int, item) -> int:
+        """Where the post is in the pool, counting from 0"""
+        if item['id'] in self.positions:
+            return self.positions[item['id']]
+        return index + (page_num - 1) * self.posts_per_page
+
+    def process_page(self, page):
+        page_num, posts = page
+        with self._lock:
+            self.items_found += len(posts)
+            self.posts_seen += len(posts)
+        if self.metadata is not None:
+            self.metadata.add_posts(posts)
+
+        for index, item in enumerate(posts):
+            position = self.position(page_num, index, item)
+            with self._lock:
+                self._processed_positions[item['id']] = position
+            self.queue_download(item, '{:04d}_{:d}_{}.{}'.format(position, item['id'], item['md5'], item['file_ext']))
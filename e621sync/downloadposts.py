@@ -1,43 +1,85 @@
 import os
-from typing import Dict
-
-import requests
-
+import time
+import functools
+from threading import Lock
+from typing import Dict, Any, Optional, Tuple
+
+# orjson is optional, but parses listing pages several times faster
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+from .filedownloader import FileDownloader
 from .threadpool import ThreadPool, LowPriorityJob, HighPriorityJob
 from .rule import Rule
-from .globalsettings import USER_AGENT, HTTP_DEFAULT_TIMEOUT
+from .rulefilter import RuleFilter
+from .stateindex import StateIndex
+from .dedup import DownloadRegistry
+from .metadatastore import MetadataStore
 
 
 class DownloadPosts:
-    def __init__(self, thread_pool: ThreadPool, rule: Rule):
+    def __init__(self, thread_pool: ThreadPool, rule: Rule, state_index: StateIndex, incremental: bool = False,
+                 registry: DownloadRegistry = None, plan=None, metadata: MetadataStore = None):
         self.thread_pool = thread_pool
         self.rule = rule
+        self.state_index = state_index
+        # shared between rules so a post matched by several rules is only downloaded once
+        self.registry = registry if registry is not None else DownloadRegistry(state_index)
+        self.downloader = FileDownloader(thread_pool.session, thread_pool.disk_writer)
+        self.filter = RuleFilter(rule)
+        # with a SyncPlan nothing is downloaded or recorded, matching posts are just added to the plan
+        self.plan = plan
+        # if set, the metadata of every post the rule matches is kept for local searches
+        self.metadata = metadata
+        self.incremental = incremental
+        # queued downloads that haven't finished yet, download filename -> (post, filename), see checkpoint()
+        self._pending = {}  # type: Dict[str, Tuple[Dict[str, Any], str]]
         self.items_found = 0
         self.items_queued = 0
-        thread_pool.add_job(HighPriorityJob(self.process_rule))
+        self.highest_id = None
+
+        # Listing pages are fetched ahead of being processed, up to rule.listing_lookahead pages ahead
+        self._lock = Lock()
+        self._pages_in_progress = 1
+        self._deferred_listing = None
+        self._listing_done = False
+        self._listing_failed = False
 
-    @staticmethod
-    def get_json(url: str, request_vars: Dict[str, str]):
-        r = requests.get(url, request_vars, headers={'User-Agent': USER_AGENT}, timeout=HTTP_DEFAULT_TIMEOUT)
-        json = r.json()
+        # In incremental mode stop paging once we get back to what the last completed sync had already seen
+        self.previous_high_water_mark = state_index.get_high_water_mark(rule.name) if incremental else None
+        thread_pool.set_group(rule.name, rule.priority, rule.max_concurrent)
+        thread_pool.add_job(HighPriorityJob(self.process_rule), rule.name)
+
+    def get_json(self, url: str, request_vars: Dict[str, str]):
+        json = json_loads(self.thread_pool.session.get_cached(url, request_vars))
 
         if 'success' in json and json['success'] is False:
             raise Exception('Error getting list: {}'.format(json['reason']))
 
         return json
 
-    def download_item(self, url: str, filename: str):
-        r = requests.get(url, headers={'User-Agent': USER_AGENT}, timeout=HTTP_DEFAULT_TIMEOUT)
-
-        if not os.path.exists(self.rule.download_directory):
-            os.makedirs(self.rule.download_directory)
+    def download_item(self, url: str, filename: str, post_id: int, md5: str):
+        start = time.perf_counter()
+        bytes_written = self.downloader.download(url, filename, md5)
+        with self._lock:
+            self._pending.pop(filename, None)
 
-        with open(filename, 'wb') as f:
-            bytes_written = f.write(r.content)
+        self.thread_pool.metrics.record_download(self.rule.name, bytes_written, time.perf_counter() - start)
+        self.state_index.add_download(filename, post_id, md5, self.rule.name)
+        self.registry.complete(md5, filename)
 
         print('[{:d}]  <{}>  Downloaded {:s}  ({:.0f} KB)'.format(self.thread_pool.job_queue.qsize(), self.rule.name,
                                                                   filename, bytes_written / 1024))
 
+    def download_failed(self, filename: str, md5: str):
+        """The download won't be tried again this run, so release its claim on the file.  Otherwise the registry would
+           skip it (and anything waiting on it) for as long as the process runs, e.g. every poll of --daemon"""
+        self.registry.release(md5)
+        with self._lock:
+            self._pending.pop(filename, None)
+
     def get_listing(self, before_id: int = None):
         post_vars = {'tags': ' '.join(self.rule.tags), 'limit': self.rule.list_limit}
 
@@ -45,35 +87,149 @@ class DownloadPosts:
         if before_id is not None:
             post_vars['before_id'] = str(before_id)
 
-        return self.get_json('https://e621.net/post/index.json', post_vars)
+        return self.get_json(self.thread_pool.session.api_url + '/post/index.json', post_vars)
 
-    def queue_download(self, url: str, filename: str):
+    def queue_download(self, item: Dict[str, Any], filename: str):
         """Join the rule directory with the base filename, and if it hasn't already been downloaded, queue it up"""
         full_filename = os.path.join(self.rule.download_directory, filename)
-        if not os.path.exists(full_filename):
-            self.thread_pool.add_job(LowPriorityJob(self.download_item, url, full_filename))
+
+        # Incremental syncs trust the index, so a post already synced costs no stat().  Full syncs are how missing files
+        # get picked up, so they check the disk and forget any download that has gone
+        if self.state_index.is_downloaded(full_filename):
+            if self.incremental or os.path.exists(full_filename):
+                if self.plan is not None:
+                    self.plan.add_existing(self.rule.name)
+                return
+            self.state_index.remove_download(full_filename)
+
+        # Files downloaded before the index existed (or by something else) only need to be stat()ed once
+        elif os.path.exists(full_filename):
+            if self.plan is not None:
+                self.plan.add_existing(self.rule.name)
+            else:
+                self.state_index.add_download(full_filename, item['id'], item['md5'], self.rule.name)
+            return
+
+        if self.plan is not None:
+            self.plan.add_download(self.rule.name, item, filename,
+                                   self.registry.is_downloaded(item['md5'], item['file_ext']))
+            with self._lock:
+                self.items_queued += 1
+            return
+
+        download_filename = self.registry.claim(item['md5'], item['file_ext'], full_filename, item['id'],
+                                                self.rule.name)
+        if download_filename is None:
+            return
+
+        with self._lock:
             self.items_queued += 1
+            self._pending[download_filename] = (item, filename)
+        job = LowPriorityJob(self.download_item, item['file_url'], download_filename, item['id'], item['md5'])
+        job.on_failure = functools.partial(self.download_failed, download_filename, item['md5'])
+        self.thread_pool.add_job(job, self.rule.name)
+
+    def checkpoint(self, plan):
+        """Add the downloads that were queued but haven't finished to a SyncPlan, along with any other rule's posts
+           waiting to be linked to them"""
+        with self._lock:
+            pending = list(self._pending.values())
+
+        for item, filename in pending:
+            plan.add_download(self.rule.name, item, filename)
+            for waiting_filename, _, rule_name in self.registry.waiting(item['md5']):
+                if (rule_name, os.path.basename(waiting_filename)) != (self.rule.name, filename):
+                    plan.add_download(rule_name, item, os.path.basename(waiting_filename))
 
     def process_rule(self, before_id: int = None):
+        """Fetch a listing page.  The next page is requested as soon as we know where this one ends, before this page
+           is processed"""
         items = self.get_listing(before_id)
-        self.items_found += len(items)
-
-        for item in items:
-            # keep track of were we are up to
-            if before_id is None or item['id'] < before_id:
-                before_id = item['id']
-
-            # client side tag check
-            if self.rule.has_blacklisted_tag(item['tags'].split(' ')):
-                continue
-
-            self.queue_download(item['file_url'], '{:d}_{}.{}'.format(item['id'], item['md5'], item['file_ext']))
 
-        # if we found items to download with the last before_id value, try the next listing
+        # if we found items with the last before_id value, try the next listing (unless we've caught up)
+        next_before_id = None
         if len(items) > 0:
-            self.thread_pool.add_job(HighPriorityJob(self.process_rule, before_id))
-        else:
-            self.print_rule_summary()
+            lowest_id = min(item['id'] for item in items)
+            if not self.reached_high_water_mark(lowest_id):
+                next_before_id = lowest_id
+
+        self.listing_fetched(next_before_id, items)
+
+    def process_page(self, items):
+        with self._lock:
+            self.items_found += len(items)
+            for item in items:
+                if self.highest_id is None or item['id'] > self.highest_id:
+                    self.highest_id = item['id']
+
+        matched = self.filter.filter_page(items)
+        if self.metadata is not None:
+            self.metadata.add_posts(matched)
+
+        for item in matched:
+            self.queue_download(item, '{:d}_{}.{}'.format(item['id'], item['md5'], item['file_ext']))
+
+    def listing_fetched(self, next_listing, page):
+        """Start fetching the next listing page (if there is one and we're not too far ahead), then queue this page to
+           be processed.  next_listing is the argument for the next process_rule call, or None if this was the last"""
+        with self._lock:
+            if next_listing is None:
+                self._listing_done = True
+            elif self._pages_in_progress <= self.rule.listing_lookahead:
+                self._pages_in_progress += 1
+                self.thread_pool.add_job(HighPriorityJob(self.process_rule, next_listing), self.rule.name)
+            else:
+                self._deferred_listing = next_listing
+
+        self.thread_pool.add_job(HighPriorityJob(self._process_page_job, page), self.rule.name)
+
+    def _process_page_job(self, page):
+        try:
+            self.process_page(page)
+        except BaseException:
+            with self._lock:
+                self._listing_failed = True
+            raise
+        finally:
+            with self._lock:
+                self._pages_in_progress -= 1
+                if self._deferred_listing is not None:
+                    self._pages_in_progress += 1
+                    self.thread_pool.add_job(HighPriorityJob(self.process_rule, self._deferred_listing),
+                                             self.rule.name)
+                    self._deferred_listing = None
+                finished = self._listing_done and self._pages_in_progress == 0
+
+            if finished:
+                self.finish_rule()
+
+    def reached_high_water_mark(self, lowest_id: int) -> bool:
+        """Has the listing gone back far enough to reach posts seen by the last completed sync"""
+        return self.previous_high_water_mark is not None and lowest_id <= self.previous_high_water_mark
+
+    def high_water_mark(self) -> Optional[int]:
+        """The newest post listed.  If any of the rule's downloads failed, only up to just below the oldest of those, so
+           the next incremental sync lists it again"""
+        failed = self.registry.failed_posts(self.rule.name)
+        if failed and self.highest_id is not None:
+            return min(self.highest_id, min(failed) - 1)
+        return self.highest_id
+
+    def listing_complete(self) -> bool:
+        """Has every listing page been fetched and processed without an error"""
+        with self._lock:
+            return self._listing_done and self._pages_in_progress == 0 and not self._listing_failed
+
+    def save_high_water_mark(self):
+        """Called once the pool has finished every job (and wasn't interrupted), so every download the rule queued has
+           either succeeded or failed for good"""
+        mark = self.high_water_mark()
+        if mark is not None and self.plan is None and self.listing_complete():
+            self.state_index.update_high_water_mark(self.rule.name, mark)
+
+    def finish_rule(self):
+        """Called once the last listing page has been processed"""
+        self.print_rule_summary()
 
     def print_rule_summary(self):
         print('[{:d}]  <{}>  Found {:d} items, {:d} queued for download'.format(
@@ -0,0 +1,144 @@
+import os
+import json
+import hashlib
+from typing import Optional, Dict, Any, Tuple
+
+import requests
+
+from .httpsession import HttpSession, RetryableException, RequestCancelledException
+from .diskwriter import DiskWriter
+from .globalsettings import DOWNLOAD_CHUNK_SIZE, PARTIAL_DOWNLOAD_SUFFIX, PARTIAL_METADATA_SUFFIX
+
+
+class ChecksumException(RetryableException):
+    """The downloaded bytes don't match the md5 from the listing"""
+    pass
+
+
+class DownloadCancelledException(RequestCancelledException):
+    """The sync is being stopped, so the download was abandoned part way through"""
+    pass
+
+
+class FileDownloader:
+    """Streams a file to a .part file next to its final name, and only renames it into place once the md5 matches
+
+       If the transfer fails part way through, the .part file is kept along with the url and ETag/Last-Modified of the
+       response and the number of bytes safely on disk, so the next attempt can ask for just the missing bytes with a
+       Range request.  If-Range makes the server send the whole file again if it has changed since.
+
+       The offset is recorded rather than taken from the size of the .part file, which is preallocated to the full
+       size and only cut back to what was written when it's closed.  After a crash the file is truncated back to the
+       last recorded offset."""
+
+    def __init__(self, session: HttpSession, writer: DiskWriter = None):
+        self.session = session
+        # the network worker only hashes each chunk, writing and syncing happens on the writer's threads
+        self.writer = writer if writer is not None else DiskWriter()
+
+    @staticmethod
+    def _load_metadata(filename: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(filename, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _save_metadata(filename: str, metadata: Dict[str, Any]):
+        with open(filename, 'w') as f:
+            json.dump(metadata, f)
+
+    @staticmethod
+    def _remove(*filenames: str):
+        for filename in filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    @staticmethod
+    def _hash_file(filename: str, hasher):
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+
+    def _resume_offset(self, url: str, partial_filename: str, metadata_filename: str) -> Tuple[int, Dict[str, str]]:
+        """How many bytes of a previous partial download of url are on disk, and the Range headers to continue it.  Or
+           0 and no headers to start from scratch"""
+        metadata = self._load_metadata(metadata_filename)
+        if metadata is None or metadata.get('url') != url or not os.path.exists(partial_filename):
+            return 0, {}
+
+        validator = metadata.get('etag') or metadata.get('last_modified')
+        offset = metadata.get('offset')
+        if validator is None or type(offset) is not int or offset <= 0 or os.path.getsize(partial_filename) < offset:
+            return 0, {}
+
+        return offset, {'Range': 'bytes={:d}-'.format(offset), 'If-Range': validator}
+
+    def download(self, url: str, filename: str, md5: str = None) -> int:
+        """Download url to filename, returning the number of bytes transferred by this attempt"""
+        partial_filename = filename + PARTIAL_DOWNLOAD_SUFFIX
+        metadata_filename = filename + PARTIAL_METADATA_SUFFIX
+        offset, headers = self._resume_offset(url, partial_filename, metadata_filename)
+        hasher = hashlib.md5()
+        bytes_written = 0
+        metadata = None
+
+        with self.session.get(url, kind='cdn', stream=True, headers=headers) as r:
+            if r.status_code == 416:
+                # our partial file doesn't fit what the server has, start again next time
+                self._remove(partial_filename, metadata_filename)
+                raise RetryableException('{}: partial download no longer valid'.format(url))
+            r.raise_for_status()
+
+            if r.status_code == 206:
+                # resuming, so drop anything past the recorded offset and include the bytes we already have in the md5
+                os.truncate(partial_filename, offset)
+                self._hash_file(partial_filename, hasher)
+            else:
+                offset = 0
+
+            if 'ETag' in r.headers or 'Last-Modified' in r.headers:
+                self.writer.directories.make(os.path.dirname(filename))
+                metadata = {'url': url, 'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified'),
+                            'offset': offset}
+                self._save_metadata(metadata_filename, metadata)
+
+            content_length = r.headers.get('Content-Length')
+            expected_size = int(content_length) if content_length and content_length.isdigit() else None
+            handle = self.writer.open(partial_filename, r.status_code == 206, expected_size)
+            try:
+                for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    if self.session.cancelled.is_set():
+                        raise DownloadCancelledException('cancelled')
+                    hasher.update(chunk)
+                    self.writer.write(handle, chunk)
+                    bytes_written += len(chunk)
+
+                # urllib3 1.x doesn't raise when the connection closes before Content-Length bytes have arrived
+                if expected_size is not None and bytes_written < expected_size:
+                    raise requests.ConnectionError('connection closed after {:d} of {:d} bytes'.format(bytes_written,
+                                                                                                    expected_size))
+            except (requests.RequestException, DownloadCancelledException) as e:
+                # connection dropped (or we're stopping) part way through the transfer, keep what we have to resume from
+                self.writer.close(handle).result()
+                if metadata is not None:
+                    metadata['offset'] = offset + bytes_written
+                    self._save_metadata(metadata_filename, metadata)
+                # a connection dropped by cancelling isn't worth a retry either
+                exception = DownloadCancelledException if self.session.cancelled.is_set() else RetryableException
+                raise exception('{}: {}  (kept {:d} bytes to resume from)'.format(url, e, bytes_written))
+            except BaseException:
+                self.writer.close(handle)
+                raise
+
+        # waits for the writer to get everything onto the disk
+        self.writer.close(handle).result()
+
+        if md5 is not None and hasher.hexdigest() != md5:
+            self._remove(partial_filename, metadata_filename)
+            raise ChecksumException('{}: md5 mismatch, expected {} got {}'.format(url, md5, hasher.hexdigest()))
+
+        os.replace(partial_filename, filename)
+        self._remove(metadata_filename)
+        return bytes_written
@@ -1,3 +1,9 @@
 VERSION = '0.45'
 USER_AGENT = 'e621sync/{} (e621 username zero https://github.com/mdavey/e621sync)'.format(VERSION)
 HTTP_DEFAULT_TIMEOUT = 30
+API_URL = 'https://e621.net'
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+PARTIAL_DOWNLOAD_SUFFIX = '.part'
+PARTIAL_METADATA_SUFFIX = '.part.json'
+JOB_MAX_RETRIES = 5
+AUTOSCALE_INTERVAL = 10
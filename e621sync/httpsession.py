@@ -0,0 +1,149 @@
+import time
+from threading import Event
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .ratelimit import RateLimiter
+from .metrics import Metrics
+from .responsecache import ResponseCache
+from .globalsettings import USER_AGENT, HTTP_DEFAULT_TIMEOUT, API_URL
+
+
+class RetryableException(Exception):
+    """A request failed in a way that is likely to succeed if the job is tried again later"""
+    pass
+
+
+class RequestCancelledException(RetryableException):
+    """The session was cancelled, so the request was abandoned.  It would succeed on the next run"""
+    pass
+
+
+class HttpSession:
+    """A keep-alive requests.Session shared by all workers of a ThreadPool
+
+       urllib3 connection pools are thread safe, so one session sized to the number of workers lets every worker reuse
+       an already open connection instead of paying for a new TCP+TLS handshake on each request"""
+
+    # responses that mean the server wants us to slow down or come back later
+    RETRY_STATUS_CODES = (429, 503)
+
+    def __init__(self, pool_size: int, api_rate_limit: float = 0, cdn_rate_limit: float = 0, metrics: Metrics = None,
+                 api_url: str = API_URL, cache: ResponseCache = None):
+        self.pool_size = pool_size
+        self.api_url = api_url.rstrip('/')
+        self.cache = cache
+        # set to abort streamed downloads part way through
+        self.cancelled = Event()
+        self.metrics = metrics if metrics is not None else Metrics()
+        # listing calls and file downloads go to different servers with different limits
+        self.rate_limiters = {'api': RateLimiter(api_rate_limit, cancelled=self.cancelled),
+                              'cdn': RateLimiter(cdn_rate_limit, cancelled=self.cancelled)}
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+
+        # pool_connections is the number of hosts to keep pools for (api + file cdn), pool_maxsize is the number of
+        # connections kept open per host, which should match the number of workers that may use it at the same time
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._adapters = [adapter]
+
+    def get(self, url: str, request_vars: Dict[str, str] = None, kind: str = 'api', **kwargs) -> requests.Response:
+        """Rate limited GET.  kind is 'api' or 'cdn' and picks which limiter the request counts against"""
+        kwargs.setdefault('timeout', HTTP_DEFAULT_TIMEOUT)
+        rate_limiter = self.rate_limiters[kind]
+        if not rate_limiter.acquire():
+            raise RequestCancelledException('{}: cancelled'.format(url))
+
+        start = time.perf_counter()
+        try:
+            r = self.session.get(url, params=request_vars, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            rate_limiter.backoff()
+            raise RetryableException('{}: {}'.format(url, e))
+
+        # for streamed requests this is the time to the response headers, transfer time is recorded per download
+        self.metrics.record_request(kind, time.perf_counter() - start)
+
+        if r.status_code in self.RETRY_STATUS_CODES:
+            delay = rate_limiter.backoff(self._parse_retry_after(r.headers.get('Retry-After')))
+            r.close()
+            raise RetryableException('{}: HTTP {:d}, backing off for {:.1f}s'.format(url, r.status_code, delay))
+
+        rate_limiter.success()
+        return r
+
+    def get_cached(self, url: str, request_vars: Dict[str, str] = None) -> bytes:
+        """GET the body of an api response, going through the response cache if there is one"""
+        if self.cache is None:
+            r = self.get(url, request_vars, kind='api')
+            r.raise_for_status()
+            return r.content
+
+        key = self.cache.key(url, request_vars)
+        cached = self.cache.get(key)
+        if cached is not None and self.cache.is_fresh(cached):
+            return cached.body
+
+        headers = {}
+        if cached is not None and cached.etag is not None:
+            headers['If-None-Match'] = cached.etag
+        if cached is not None and cached.last_modified is not None:
+            headers['If-Modified-Since'] = cached.last_modified
+
+        r = self.get(url, request_vars, kind='api', headers=headers)
+        if r.status_code == 304 and cached is not None:
+            self.cache.refreshed(key)
+            return cached.body
+
+        r.raise_for_status()
+        self.cache.put(key, r.content, r.headers.get('ETag'), r.headers.get('Last-Modified'))
+        return r.content
+
+    @staticmethod
+    def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+        """Retry-After can either be a number of seconds or a HTTP date"""
+        if value is None:
+            return None
+
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+    def _connection_pools(self):
+        for adapter in self._adapters:
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is not None:
+                    yield pool
+
+    @property
+    def connections_opened(self) -> int:
+        return sum(pool.num_connections for pool in self._connection_pools())
+
+    @property
+    def connections_reused(self) -> int:
+        return sum(pool.num_requests - pool.num_connections for pool in self._connection_pools())
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def close(self):
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    def __str__(self) -> str:
+        return 'HttpSession<pool_size: {:d}>  connections opened: {:d}  reused: {:d}'.format(
+            self.pool_size, self.connections_opened, self.connections_reused)
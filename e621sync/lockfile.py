@@ -0,0 +1,59 @@
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+class LockFileException(Exception):
+    pass
+
+
+class LockFile:
+    """Stops two copies of e621sync running against the same files at once, e.g. a slow cron run and the next one
+
+       The file is locked with flock (or msvcrt.locking on Windows) rather than just created, so the lock goes away
+       with the process even if it's killed"""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._file = None
+
+    def acquire(self):
+        f = open(self.filename, 'a+')
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            f.close()
+            raise LockFileException('Another e621sync is already running (lock file {})'.format(self.filename))
+
+        # the pid is only for people wondering which process has the lock
+        f.seek(0)
+        f.truncate()
+        f.write('{:d}\n'.format(os.getpid()))
+        f.flush()
+        self._file = f
+
+    def release(self):
+        if self._file is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -0,0 +1,124 @@
+import sqlite3
+from threading import Lock
+from typing import Dict, List, Any, Optional
+
+
+class MetadataStore:
+    """Keeps the metadata of every post synced (tags, score, rating, md5, sizes) as it's listed, for local searches
+
+       Tags are interned: each tag name is stored once, and each post's tags are (tag id, post id) rows clustered by
+       tag, so finding every post with a tag is a range scan however big the archive gets.  Posts listed again replace
+       their earlier metadata, so tag edits on the site are picked up by the next sync."""
+
+    # number of pages to batch up before committing
+    COMMIT_INTERVAL = 20
+
+    def __init__(self, filename: str = ':memory:'):
+        self.filename = filename
+        self._lock = Lock()
+        self._pending_writes = 0
+        self._tag_ids = {}  # type: Dict[str, int]
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS posts (
+                id INTEGER PRIMARY KEY,
+                md5 TEXT NOT NULL,
+                file_ext TEXT,
+                file_size INTEGER,
+                width INTEGER,
+                height INTEGER,
+                score INTEGER,
+                rating TEXT
+            );
+            CREATE TABLE IF NOT EXISTS tags (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE
+            );
+            CREATE TABLE IF NOT EXISTS post_tags (
+                tag_id INTEGER NOT NULL,
+                post_id INTEGER NOT NULL,
+                PRIMARY KEY (tag_id, post_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS post_tags_post ON post_tags (post_id);
+        ''')
+        self._db.commit()
+        self._tag_ids = dict(self._db.execute('SELECT name, id FROM tags'))
+
+    def _tag_id(self, name: str) -> int:
+        tag_id = self._tag_ids.get(name)
+        if tag_id is None:
+            tag_id = self._db.execute('INSERT INTO tags (name) VALUES (?)', (name,)).lastrowid
+            self._tag_ids[name] = tag_id
+        return tag_id
+
+    def add_posts(self, items: List[Dict[str, Any]]):
+        """Store (or update) a page of posts from a listing"""
+        if not items:
+            return
+
+        with self._lock:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO posts (id, md5, file_ext, file_size, width, height, score, rating) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(item['id'], item['md5'], item.get('file_ext'), item.get('file_size'), item.get('width'),
+                  item.get('height'), item.get('score'), item.get('rating')) for item in items])
+            self._db.executemany('DELETE FROM post_tags WHERE post_id = ?', [(item['id'],) for item in items])
+            self._db.executemany('INSERT OR IGNORE INTO post_tags (tag_id, post_id) VALUES (?, ?)',
+                                 [(self._tag_id(tag), item['id']) for item in items
+                                  for tag in item.get('tags', '').split(' ') if tag])
+
+            self._pending_writes += 1
+            if self._pending_writes >= self.COMMIT_INTERVAL:
+                self._db.commit()
+                self._pending_writes = 0
+
+    def query(self, tags: List[str], limit: int = None) -> List[int]:
+        """Ids of the posts with every tag, except tags starting with '-' which the posts must not have.  Newest
+           first"""
+        include = [tag for tag in tags if not tag.startswith('-')]
+        exclude = [tag[1:] for tag in tags if tag.startswith('-')]
+
+        with self._lock:
+            # a tag that has never been seen can't match anything
+            if any(tag not in self._tag_ids for tag in include):
+                return []
+
+            if include:
+                selects = ['SELECT post_id FROM post_tags WHERE tag_id = ?'] * len(include)
+                sql = ' INTERSECT '.join(selects)
+                params = [self._tag_ids[tag] for tag in include]
+            else:
+                sql = 'SELECT id FROM posts'
+                params = []
+
+            exclude_ids = [self._tag_ids[tag] for tag in exclude if tag in self._tag_ids]
+            if exclude_ids:
+                sql += ' EXCEPT SELECT post_id FROM post_tags WHERE tag_id IN ({})'.format(
+                    ', '.join('?' * len(exclude_ids)))
+                params += exclude_ids
+
+            sql = 'SELECT * FROM ({}) ORDER BY 1 DESC'.format(sql)
+            if limit is not None:
+                sql += ' LIMIT {:d}'.format(limit)
+            return [row[0] for row in self._db.execute(sql, params)]
+
+    def get_post(self, post_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute('SELECT id, md5, file_ext, file_size, width, height, score, rating FROM posts '
+                                   'WHERE id = ?', (post_id,)).fetchone()
+            if row is None:
+                return None
+            post = dict(zip(('id', 'md5', 'file_ext', 'file_size', 'width', 'height', 'score', 'rating'), row))
+            post['tags'] = ' '.join(sorted(name for (name,) in self._db.execute(
+                'SELECT name FROM tags JOIN post_tags ON tags.id = post_tags.tag_id WHERE post_id = ?', (post_id,))))
+            return post
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+            self._pending_writes = 0
+
+    def close(self):
+        self.commit()
+        with self._lock:
+            self._db.close()
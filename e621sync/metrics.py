@@ -0,0 +1,229 @@
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+from threading import Lock
+from collections import deque
+from typing import Dict, List, Any, Callable, Optional, Deque
+
+# request latency buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# how often to record the queue depth, in seconds
+QUEUE_DEPTH_INTERVAL = 1.0
+
+# how many queue depth samples to keep, older ones are dropped so a long running --daemon doesn't keep them all
+QUEUE_DEPTH_SAMPLES = 3600
+
+# From Python 3.12 cProfile is built on sys.monitoring, which only allows one active profiler in the process, but that
+# one sees every thread.  Before that, each thread needs its own
+PROCESS_WIDE_PROFILER = sys.version_info >= (3, 12)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def summary(self) -> Dict[str, Any]:
+        return {'count': self.count, 'sum': round(self.sum, 6),
+                'buckets': {str(bucket): count for bucket, count in zip(self.buckets + ('+Inf',), self.counts)}}
+
+
+class RuleMetrics:
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def summary(self) -> Dict[str, Any]:
+        return {'files': self.files, 'bytes': self.bytes, 'seconds': round(self.seconds, 3),
+                'bytes_per_second': round(self.bytes / self.seconds) if self.seconds else 0}
+
+
+class Metrics:
+    """Thread safe counters for a sync, so it's possible to tell whether the API, the CDN, the disk or the number of
+       workers is the bottleneck"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.started = time.monotonic()
+        self.workers = 1
+        self.requests = {}  # type: Dict[str, Histogram]
+        self.rules = {}  # type: Dict[str, RuleMetrics]
+        self.retries = 0
+        self.jobs = 0
+        self.busy_seconds = 0.0
+        self.queue_depth = deque(maxlen=QUEUE_DEPTH_SAMPLES)  # type: Deque[List[float]]
+        self._last_queue_sample = None
+
+    def start(self, workers: int):
+        with self._lock:
+            self.started = time.monotonic()
+            self.workers = workers
+
+    def record_request(self, kind: str, seconds: float):
+        with self._lock:
+            if kind not in self.requests:
+                self.requests[kind] = Histogram()
+            self.requests[kind].observe(seconds)
+
+    def record_download(self, rule_name: str, bytes_written: int, seconds: float):
+        with self._lock:
+            if rule_name not in self.rules:
+                self.rules[rule_name] = RuleMetrics()
+            rule = self.rules[rule_name]
+            rule.files += 1
+            rule.bytes += bytes_written
+            rule.seconds += seconds
+
+    def bytes_downloaded(self) -> int:
+        with self._lock:
+            return sum(rule.bytes for rule in self.rules.values())
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def record_job(self, seconds: float):
+        with self._lock:
+            self.jobs += 1
+            self.busy_seconds += seconds
+
+    def sample_queue_depth(self, depth: int):
+        """Cheap to call for every job, only keeps one sample per QUEUE_DEPTH_INTERVAL"""
+        now = time.monotonic()
+        with self._lock:
+            if self._last_queue_sample is None or now - self._last_queue_sample >= QUEUE_DEPTH_INTERVAL:
+                self._last_queue_sample = now
+                self.queue_depth.append([round(now - self.started, 3), depth])
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            elapsed = time.monotonic() - self.started
+            return {
+                'elapsed_seconds': round(elapsed, 3),
+                'workers': self.workers,
+                'jobs': self.jobs,
+                'retries': self.retries,
+                'worker_utilization': round(self.busy_seconds / (elapsed * self.workers), 4) if elapsed else 0,
+                'requests': {kind: histogram.summary() for kind, histogram in self.requests.items()},
+                'rules': {name: rule.summary() for name, rule in self.rules.items()},
+                'queue_depth': list(self.queue_depth),
+            }
+
+    def write_json(self, filename: str):
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_prometheus(self, filename: str):
+        """Write the metrics in the Prometheus text format, e.g. for the node_exporter textfile collector"""
+        summary = self.summary()
+        lines = ['# TYPE e621sync_elapsed_seconds gauge',
+                 'e621sync_elapsed_seconds {}'.format(summary['elapsed_seconds']),
+                 '# TYPE e621sync_jobs_total counter',
+                 'e621sync_jobs_total {}'.format(summary['jobs']),
+                 '# TYPE e621sync_retries_total counter',
+                 'e621sync_retries_total {}'.format(summary['retries']),
+                 '# TYPE e621sync_worker_utilization gauge',
+                 'e621sync_worker_utilization {}'.format(summary['worker_utilization']),
+                 '# TYPE e621sync_request_seconds histogram']
+
+        for kind, histogram in summary['requests'].items():
+            cumulative = 0
+            for bucket, count in histogram['buckets'].items():
+                cumulative += count
+                lines.append('e621sync_request_seconds_bucket{{kind="{}",le="{}"}} {}'.format(kind, bucket, cumulative))
+            lines.append('e621sync_request_seconds_sum{{kind="{}"}} {}'.format(kind, histogram['sum']))
+            lines.append('e621sync_request_seconds_count{{kind="{}"}} {}'.format(kind, histogram['count']))
+
+        for metric, key in (('downloaded_files_total', 'files'), ('downloaded_bytes_total', 'bytes'),
+                            ('download_bytes_per_second', 'bytes_per_second')):
+            lines.append('# TYPE e621sync_{} {}'.format(metric, 'gauge' if key == 'bytes_per_second' else 'counter'))
+            for name, rule in summary['rules'].items():
+                lines.append('e621sync_{}{{rule="{}"}} {}'.format(metric, name.replace('"', '\\"'), rule[key]))
+
+        with open(filename, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def print_summary(self):
+        summary = self.summary()
+        print('{:d} jobs in {:.1f}s, {:d} retries, workers {:.0%} busy'.format(
+            summary['jobs'], summary['elapsed_seconds'], summary['retries'], summary['worker_utilization']))
+        for kind, histogram in sorted(summary['requests'].items()):
+            print('  {} requests: {:d}, average {:.3f}s'.format(kind, histogram['count'],
+                                                               histogram['sum'] / histogram['count']))
+        for name, rule in sorted(summary['rules'].items()):
+            print('  <{}>  {:d} files, {:.0f} KB at {:.0f} KB/s'.format(name, rule['files'], rule['bytes'] / 1024,
+                                                                     rule['bytes_per_second'] / 1024))
+
+
+class Profiler:
+    """Profiles jobs with one cProfile.Profile per thread, and merges them all at the end.  Where cProfile can only
+       have one profiler active (PROCESS_WIDE_PROFILER), a single Profile is enabled by the first job and runs until
+       write()"""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = Lock()
+        self._profiles = []  # type: List[cProfile.Profile]
+        self._process_profile = None  # type: Optional[cProfile.Profile]
+
+    def _start_process_profile(self):
+        with self._lock:
+            if self._process_profile is None:
+                self._process_profile = cProfile.Profile()
+                self._profiles.append(self._process_profile)
+                self._process_profile.enable()
+
+    def _stop_process_profile(self):
+        with self._lock:
+            if self._process_profile is not None:
+                self._process_profile.disable()
+
+    def _profile(self) -> cProfile.Profile:
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            profile = self._local.profile = cProfile.Profile()
+            with self._lock:
+                self._profiles.append(profile)
+        return profile
+
+    def run(self, fun: Callable, *args, **kwargs):
+        if PROCESS_WIDE_PROFILER:
+            self._start_process_profile()
+            return fun(*args, **kwargs)
+
+        profile = self._profile()
+        profile.enable()
+        try:
+            return fun(*args, **kwargs)
+        finally:
+            profile.disable()
+
+    def write(self, filename: str):
+        self._stop_process_profile()
+        with self._lock:
+            profiles = [profile for profile in self._profiles if profile.getstats()]
+        if not profiles:
+            return
+
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(filename)
+        stats.sort_stats('cumulative').print_stats(20)
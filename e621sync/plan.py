@@ -0,0 +1,119 @@
+import json
+from threading import Lock
+from typing import Dict, List, Any
+
+from .downloadposts import DownloadPosts
+
+# the post fields a planned download needs
+PLANNED_FIELDS = ('id', 'md5', 'file_ext', 'file_url', 'file_size')
+
+
+class PlanException(Exception):
+    pass
+
+
+class RulePlan:
+    def __init__(self):
+        self.new = 0
+        self.existing = 0
+        self.linked = 0
+        self.bytes = 0
+        self.downloads = []  # type: List[Dict[str, Any]]
+
+    def summary(self) -> Dict[str, int]:
+        return {'new': self.new, 'existing': self.existing, 'linked': self.linked, 'bytes': self.bytes}
+
+
+class SyncPlan:
+    """What a sync would do, worked out by listing every rule without downloading anything
+
+       Posts are counted as existing (already downloaded by the rule), linked (the same file is already downloaded, or
+       planned, for another rule, so it would be hard linked for free) or new.  The plan can be saved and run later,
+       which downloads the new and linked posts without listing again."""
+
+    VERSION = 1
+
+    def __init__(self):
+        self._lock = Lock()
+        self._md5s = set()
+        self.rules = {}  # type: Dict[str, RulePlan]
+
+    def _rule(self, rule_name: str) -> RulePlan:
+        if rule_name not in self.rules:
+            self.rules[rule_name] = RulePlan()
+        return self.rules[rule_name]
+
+    def add_existing(self, rule_name: str):
+        with self._lock:
+            self._rule(rule_name).existing += 1
+
+    def add_download(self, rule_name: str, item: Dict[str, Any], filename: str, already_downloaded: bool = False):
+        """filename is relative to the rule's download directory"""
+        with self._lock:
+            rule = self._rule(rule_name)
+            if already_downloaded or item['md5'] in self._md5s:
+                rule.linked += 1
+            else:
+                self._md5s.add(item['md5'])
+                rule.new += 1
+                rule.bytes += item.get('file_size', 0)
+
+            planned = {field: item.get(field) for field in PLANNED_FIELDS}
+            planned['filename'] = filename
+            rule.downloads.append(planned)
+
+    def downloads(self, rule_name: str) -> List[Dict[str, Any]]:
+        return self._rule(rule_name).downloads
+
+    def download_count(self) -> int:
+        return sum(len(rule.downloads) for rule in self.rules.values())
+
+    def summary(self) -> Dict[str, Dict[str, int]]:
+        return {name: rule.summary() for name, rule in self.rules.items()}
+
+    def print_summary(self):
+        total_new = total_bytes = 0
+        for name, rule in sorted(self.rules.items()):
+            total_new += rule.new
+            total_bytes += rule.bytes
+            print('<{}>  {:d} new ({:.1f} MB), {:d} already downloaded, {:d} linked from other rules'.format(
+                name, rule.new, rule.bytes / 1024 / 1024, rule.existing, rule.linked))
+        print('Plan: {:d} files to download, {:.1f} MB'.format(total_new, total_bytes / 1024 / 1024))
+
+    def save(self, filename: str):
+        with open(filename, 'w') as f:
+            json.dump({'version': self.VERSION,
+                       'rules': {name: dict(rule.summary(), downloads=rule.downloads)
+                                 for name, rule in self.rules.items()}}, f)
+
+    @classmethod
+    def load(cls, filename: str) -> 'SyncPlan':
+        with open(filename, 'r') as f:
+            data = json.load(f)
+        if data.get('version') != cls.VERSION:
+            raise PlanException('{}: not a plan file, or from an incompatible version'.format(filename))
+
+        plan = cls()
+        for name, saved in data['rules'].items():
+            rule = plan._rule(name)
+            for field in ('new', 'existing', 'linked', 'bytes'):
+                setattr(rule, field, saved[field])
+            rule.downloads = saved['downloads']
+        return plan
+
+
+class PlannedDownloads(DownloadPosts):
+    """Downloads a rule's posts from a saved plan instead of listing them.  Each post still goes through
+       queue_download, so anything downloaded since the plan was made is skipped"""
+
+    def __init__(self, thread_pool, rule, state_index, planned: List[Dict[str, Any]], registry=None):
+        self.planned = planned
+        super().__init__(thread_pool, rule, state_index, False, registry)
+
+    def process_rule(self):
+        for item in self.planned:
+            self.queue_download(item, item['filename'])
+        self.items_found = len(self.planned)
+
+        # nothing was listed, so leave the high water mark alone
+        self.print_rule_summary()
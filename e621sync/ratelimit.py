@@ -0,0 +1,68 @@
+import time
+import random
+from threading import Lock, Event
+
+
+class RateLimiter:
+    """Thread safe token bucket shared by every job making the same kind of request
+
+       After the server pushes back (429/503 or a dropped connection) every caller is paused, for the Retry-After time
+       if the server gave one, otherwise for an exponentially growing, jittered delay.  Either way the pause is at most
+       BACKOFF_MAX, and callers stop waiting as soon as cancelled is set.  A successful request resets the backoff.  A
+       rate of 0 disables the limit, but still honours backoff."""
+
+    BACKOFF_BASE = 1.0
+    BACKOFF_MAX = 120.0
+
+    def __init__(self, rate: float, burst: int = None, cancelled: Event = None):
+        self.rate = rate
+        self.cancelled = cancelled if cancelled is not None else Event()
+        self.burst = burst if burst is not None else max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._last_refill = time.monotonic()
+        self._resume_at = 0.0
+        self._failures = 0
+        self._lock = Lock()
+
+    def _reserve(self) -> float:
+        """Take a token if one is available, otherwise return how long to wait before trying again"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._resume_at:
+                return self._resume_at - now
+
+            if self.rate <= 0:
+                return 0.0
+
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self) -> bool:
+        """Block until a request is allowed.  Returns False if cancelled was set while waiting"""
+        while True:
+            wait = self._reserve()
+            if wait <= 0:
+                return True
+            if self.cancelled.wait(wait):
+                return False
+
+    def backoff(self, retry_after: float = None) -> float:
+        """Pause all requests.  Returns the delay used"""
+        with self._lock:
+            self._failures += 1
+            if retry_after is not None:
+                # a server asking for an hour shouldn't hold up stopping for an hour
+                delay = min(retry_after, self.BACKOFF_MAX)
+            else:
+                delay = random.uniform(self.BACKOFF_BASE,
+                                       min(self.BACKOFF_MAX, self.BACKOFF_BASE * (2 ** self._failures)))
+            self._resume_at = max(self._resume_at, time.monotonic() + delay)
+            return delay
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
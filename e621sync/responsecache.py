@@ -0,0 +1,114 @@
+import time
+import sqlite3
+from collections import namedtuple
+from threading import Lock
+from urllib.parse import urlencode
+from typing import Dict, Optional
+
+CachedResponse = namedtuple('CachedResponse', ['body', 'etag', 'last_modified', 'fetched'])
+
+
+class ResponseCache:
+    """On disk cache of listing responses, so repeated runs (dry runs, trying out a config) barely touch the API
+
+       Responses younger than ttl seconds are used as they are.  Older ones are revalidated with If-None-Match or
+       If-Modified-Since, so an unchanged page costs a 304 with no body.  Once the bodies add up to more than max_size
+       bytes, the least recently used are evicted."""
+
+    # number of last used updates to batch up before committing
+    COMMIT_INTERVAL = 50
+
+    def __init__(self, filename: str = ':memory:', ttl: float = 0, max_size: int = 100 * 1024 * 1024):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._pending_writes = 0
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fetched REAL NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+        ''')
+        self._db.commit()
+        self.size = self._db.execute('SELECT COALESCE(SUM(LENGTH(body)), 0) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def key(url: str, request_vars: Dict[str, str] = None) -> str:
+        return url + '?' + urlencode(sorted((request_vars or {}).items()))
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        """The cached response for key, fresh or not, or None"""
+        with self._lock:
+            row = self._db.execute('SELECT body, etag, last_modified, fetched FROM responses WHERE key = ?',
+                                   (key,)).fetchone()
+            if row is None:
+                return None
+
+            response = CachedResponse(*row)
+            if self.is_fresh(response):
+                self.hits += 1
+            self._db.execute('UPDATE responses SET last_used = ? WHERE key = ?', (time.time(), key))
+            self._pending_writes += 1
+            if self._pending_writes >= self.COMMIT_INTERVAL:
+                self._db.commit()
+                self._pending_writes = 0
+        return response
+
+    def is_fresh(self, response: CachedResponse) -> bool:
+        return time.time() - response.fetched < self.ttl
+
+    def put(self, key: str, body: bytes, etag: str = None, last_modified: str = None):
+        now = time.time()
+        with self._lock:
+            self.misses += 1
+            if len(body) > self.max_size:
+                return
+
+            row = self._db.execute('SELECT LENGTH(body) FROM responses WHERE key = ?', (key,)).fetchone()
+            self._db.execute('INSERT OR REPLACE INTO responses (key, body, etag, last_modified, fetched, last_used) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', (key, body, etag, last_modified, now, now))
+            self.size += len(body) - (row[0] if row is not None else 0)
+            self._evict()
+            self._db.commit()
+            self._pending_writes = 0
+
+    def refreshed(self, key: str):
+        """The server says the cached response is still current, so it's good for another ttl seconds"""
+        now = time.time()
+        with self._lock:
+            self.revalidated += 1
+            self._db.execute('UPDATE responses SET fetched = ?, last_used = ? WHERE key = ?', (now, now, key))
+            self._db.commit()
+            self._pending_writes = 0
+
+    def _evict(self):
+        """Drop least recently used responses until the cache fits in max_size again"""
+        while self.size > self.max_size:
+            rows = self._db.execute('SELECT key, LENGTH(body) FROM responses ORDER BY last_used LIMIT 100').fetchall()
+            if not rows:
+                self.size = 0
+                return
+            for key, size in rows:
+                self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.size -= size
+                if self.size <= self.max_size:
+                    return
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+    def __str__(self):
+        return 'Listing cache: {:d} hits, {:d} revalidated, {:d} misses'.format(self.hits, self.revalidated,
+                                                                                self.misses)
@@ -13,6 +13,21 @@ class Rule:
         self.blacklist_tags = []
         self.minimum_score = -10
         self.list_limit = 100
+        self.listing_lookahead = 2
+
+        # share of the workers compared to other rules, and the most jobs that can run at once (0 for no limit)
+        self.priority = 1
+        self.max_concurrent = 0
+
+        # seconds between polls in --daemon mode
+        self.poll_interval = 600
+
+        # client side only filters, these don't use up any of the 6 tags sent to the server
+        self.check_minimum_score = False
+        self.local_tags = []
+        self.ratings = []
+        self.file_extensions = []
+        self.max_file_size = 0
 
     def __str__(self) -> str:
         return "Rule<{}>  tags: {}  download_directory: {}  blacklist_tags: {}  minimum_score: {}".format(
@@ -52,11 +67,9 @@ class Rule:
         raise RuleException('Rule has set: tag and order tag that is not "order:-id"')
 
     def has_blacklisted_tag(self, tags: List[str]) -> bool:
-        """Checks if any of the passed tags are blacklisted"""
-        for blacklisted_tag in self.blacklist_tags:
-            if blacklisted_tag in tags:
-                return True
-        return False
+        """Checks if any of the passed tags are blacklisted.  Listings are filtered by RuleFilter instead, which builds
+           its sets once per rule"""
+        return not frozenset(self.blacklist_tags).isdisjoint(tags)
 
     def get_pool_id(self) -> Optional[int]:
         pool_tag = self._find_partial_tag(self.tags, 'pool:')
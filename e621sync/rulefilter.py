@@ -0,0 +1,44 @@
+from typing import List, Dict, Any
+
+from .rule import Rule
+
+
+class RuleFilter:
+    """Client side checks for a rule, compiled once so each post on a listing page is checked with a few set lookups
+
+       Covers everything that doesn't fit (or doesn't exist) in the 6 server side tags: blacklist, minimum score,
+       ratings, file extensions, file size, and extra tags to include (or exclude with a leading '-')"""
+
+    def __init__(self, rule: Rule):
+        self.blacklist_tags = frozenset(rule.blacklist_tags)
+        self.include_tags = frozenset(tag for tag in rule.local_tags if not tag.startswith('-'))
+        self.exclude_tags = self.blacklist_tags | frozenset(tag[1:] for tag in rule.local_tags if tag.startswith('-'))
+        self.minimum_score = rule.minimum_score if rule.check_minimum_score else None
+        self.ratings = frozenset(rating[0] for rating in rule.ratings)
+        self.file_extensions = frozenset(rule.file_extensions)
+        self.max_file_size = rule.max_file_size
+        self._check_tags = bool(self.include_tags or self.exclude_tags)
+
+    def matches(self, item: Dict[str, Any]) -> bool:
+        # cheap field checks first, so we only split the tag string for posts that might be wanted
+        if self.minimum_score is not None and item.get('score', 0) <= self.minimum_score:
+            return False
+
+        if self.ratings and item.get('rating') not in self.ratings:
+            return False
+
+        if self.file_extensions and item.get('file_ext') not in self.file_extensions:
+            return False
+
+        if self.max_file_size and item.get('file_size', 0) > self.max_file_size:
+            return False
+
+        if self._check_tags:
+            tags = frozenset(item['tags'].split(' '))
+            if not self.exclude_tags.isdisjoint(tags) or not self.include_tags.issubset(tags):
+                return False
+
+        return True
+
+    def filter_page(self, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [item for item in items if self.matches(item)]
@@ -0,0 +1,96 @@
+import sqlite3
+from threading import Lock
+from typing import Optional, List
+
+
+class StateIndex:
+    """Persistent record of what has been downloaded and how far each rule has been synced
+
+       Backed by SQLite so existence checks are an indexed lookup instead of a stat() per post, which matters a lot on
+       network file systems with large download directories.  A filename of ':memory:' gives a throw away index."""
+
+    # number of writes to batch up before committing
+    COMMIT_INTERVAL = 100
+
+    def __init__(self, filename: str = ':memory:'):
+        self.filename = filename
+        self._lock = Lock()
+        self._pending_writes = 0
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS downloads (
+                filename TEXT PRIMARY KEY,
+                post_id INTEGER NOT NULL,
+                md5 TEXT NOT NULL,
+                rule TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS downloads_md5 ON downloads (md5);
+            CREATE INDEX IF NOT EXISTS downloads_post_id ON downloads (post_id);
+            CREATE TABLE IF NOT EXISTS rules (
+                name TEXT PRIMARY KEY,
+                high_water_mark INTEGER NOT NULL
+            );
+        ''')
+        self._db.commit()
+
+    def _write(self, sql: str, params: tuple):
+        with self._lock:
+            self._db.execute(sql, params)
+            self._pending_writes += 1
+            if self._pending_writes >= self.COMMIT_INTERVAL:
+                self._db.commit()
+                self._pending_writes = 0
+
+    def _read_one(self, sql: str, params: tuple):
+        with self._lock:
+            return self._db.execute(sql, params).fetchone()
+
+    def is_downloaded(self, filename: str) -> bool:
+        return self._read_one('SELECT 1 FROM downloads WHERE filename = ?', (filename,)) is not None
+
+    def add_download(self, filename: str, post_id: int, md5: str, rule_name: str):
+        self._write('INSERT OR REPLACE INTO downloads (filename, post_id, md5, rule) VALUES (?, ?, ?, ?)',
+                    (filename, post_id, md5, rule_name))
+
+    def remove_download(self, filename: str):
+        self._write('DELETE FROM downloads WHERE filename = ?', (filename,))
+
+    def find_by_md5(self, md5: str) -> Optional[str]:
+        """Returns the filename of any previous download with this md5, or None"""
+        row = self._read_one('SELECT filename FROM downloads WHERE md5 = ? LIMIT 1', (md5,))
+        return row[0] if row is not None else None
+
+    def get_filenames(self, post_id: int) -> List[str]:
+        """Every file downloaded for a post, by any rule"""
+        with self._lock:
+            return [row[0] for row in self._db.execute('SELECT filename FROM downloads WHERE post_id = ? '
+                                                       'ORDER BY filename', (post_id,))]
+
+    def get_all_filenames(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._db.execute('SELECT filename FROM downloads ORDER BY filename')]
+
+    def get_high_water_mark(self, rule_name: str) -> Optional[int]:
+        """The highest post id seen by a rule (or for pools, the number of posts synced)"""
+        row = self._read_one('SELECT high_water_mark FROM rules WHERE name = ?', (rule_name,))
+        return row[0] if row is not None else None
+
+    def lower_high_water_mark(self, rule_name: str, mark: int):
+        """Move the high water mark back, so the next incremental sync lists everything after mark again"""
+        self._write('UPDATE rules SET high_water_mark = MIN(high_water_mark, ?) WHERE name = ?', (mark, rule_name))
+
+    def update_high_water_mark(self, rule_name: str, mark: int):
+        """Only ever moves the high water mark forward"""
+        self._write('INSERT INTO rules (name, high_water_mark) VALUES (?, ?) '
+                    'ON CONFLICT (name) DO UPDATE SET high_water_mark = MAX(high_water_mark, excluded.high_water_mark)',
+                    (rule_name, mark))
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+            self._pending_writes = 0
+
+    def close(self):
+        self.commit()
+        with self._lock:
+            self._db.close()
@@ -1,70 +1,452 @@
-from threading import Thread
-from queue import PriorityQueue, Empty
+import time
+import heapq
+import itertools
+from threading import Thread, Lock, Condition
+from queue import Empty
+from typing import List, Dict, Optional
+
+from .httpsession import HttpSession, RetryableException, RequestCancelledException
+from .metrics import Metrics, Profiler
+from .diskwriter import DiskWriter
+from .globalsettings import JOB_MAX_RETRIES, AUTOSCALE_INTERVAL
+
+
+_job_sequence = itertools.count()
 
 
 class PriorityJob:
+    # there can be a lot of these queued up, so keep them small
+    __slots__ = ('priority', 'sequence', 'group', 'fun', 'args', 'kwargs', 'retries', 'on_failure')
+
     def __init__(self, priority: int, fun, *args, **kwargs):
         self.priority = priority
+        # jobs with the same priority run in the order they were created
+        self.sequence = next(_job_sequence)
+        # normally the rule name, see JobScheduler
+        self.group = None
         self.fun = fun
         self.args = args
         self.kwargs = kwargs
+        self.retries = 0
+        # called if the job fails for good, i.e. it raised something other than a RetryableException or ran out of
+        # retries
+        self.on_failure = None
 
-    def run(self):
-        self.fun(*self.args, **self.kwargs)
+    def run(self, metrics: Metrics = None, profiler: Profiler = None):
+        start = time.perf_counter()
+        try:
+            if profiler is not None:
+                profiler.run(self.fun, *self.args, **self.kwargs)
+            else:
+                self.fun(*self.args, **self.kwargs)
+        finally:
+            if metrics is not None:
+                metrics.record_job(time.perf_counter() - start)
 
     def __str__(self):
         return '{}'.format(self.fun)
 
     def __lt__(self, other):
-        return self.priority < other.priority
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+    def should_retry(self) -> bool:
+        """Count a failed attempt, and return if the job should be queued again"""
+        self.retries += 1
+        return self.retries <= JOB_MAX_RETRIES
+
+    def failed(self):
+        if self.on_failure is not None:
+            self.on_failure()
 
 
 class LowPriorityJob(PriorityJob):
+    """Downloads"""
+    __slots__ = ()
+    PRIORITY = 10
+
     def __init__(self, fun, *args, **kwargs):
-        super().__init__(10, fun, *args, **kwargs)
+        super().__init__(self.PRIORITY, fun, *args, **kwargs)
 
 
 class HighPriorityJob(PriorityJob):
+    """Listings, which produce the downloads"""
+    __slots__ = ()
+    PRIORITY = 1
+
     def __init__(self, fun, *args, **kwargs):
-        super().__init__(1, fun, *args, **kwargs)
+        super().__init__(self.PRIORITY, fun, *args, **kwargs)
+
+
+class JobGroup:
+    """The queued jobs of one rule, and how big a share of the workers it gets"""
+
+    def __init__(self, weight: int = 1, max_concurrent: int = 0):
+        self.weight = weight
+        self.max_concurrent = max_concurrent
+        self.running = 0
+        self.listings = []  # type: List[PriorityJob]
+        self.downloads = []  # type: List[PriorityJob]
+        self.current_weight = 0
+
+    def can_run(self) -> bool:
+        return not self.max_concurrent or self.running < self.max_concurrent
+
+
+class JobScheduler:
+    """Decides which job runs next, without blocking.  JobQueue adds the waiting for worker threads
+
+       Jobs are grouped by rule and groups take turns by weighted round robin, so a small rule isn't stuck behind a
+       huge backfill that happened to list first.  A group can also be capped to max_concurrent running jobs.  Within
+       a group jobs run by priority, then in the order they were added.
+
+       Listing jobs normally go first, but they produce download jobs far faster than they can be downloaded.  Once
+       max_queued_downloads downloads are queued or running, listings are held back until the downloads drain to half
+       that, so memory stays flat however big the backlog is.
+
+       Once drain() is called no more jobs are handed out, so the pool can stop as soon as the running ones finish."""
+
+    def __init__(self, max_queued_downloads: int = 1000):
+        self.high_water = max(1, max_queued_downloads)
+        self.low_water = self.high_water // 2
+        self.unfinished_jobs = 0
+        self._lock = Lock()
+        self._groups = {}  # type: Dict[Optional[str], JobGroup]
+        self._queued_listings = 0
+        self._queued_downloads = 0
+        self._running_downloads = 0
+        self._paused = False
+        self.running_jobs = 0
+        self.draining = False
+
+    @staticmethod
+    def _is_listing(job: PriorityJob) -> bool:
+        return job.priority < LowPriorityJob.PRIORITY
+
+    def _group(self, name: Optional[str]) -> JobGroup:
+        if name not in self._groups:
+            self._groups[name] = JobGroup()
+        return self._groups[name]
+
+    def set_group(self, name: str, weight: int = 1, max_concurrent: int = 0):
+        """weight is the group's share of jobs relative to other groups, max_concurrent limits how many of its jobs can
+           run at once (0 for no limit)"""
+        with self._lock:
+            group = self._group(name)
+            group.weight = max(1, weight)
+            group.max_concurrent = max_concurrent
+
+    def _push(self, job: PriorityJob):
+        self.unfinished_jobs += 1
+        group = self._group(job.group)
+        if self._is_listing(job):
+            heapq.heappush(group.listings, job)
+            self._queued_listings += 1
+        else:
+            heapq.heappush(group.downloads, job)
+            self._queued_downloads += 1
+
+    def _next_group(self, listings: bool) -> Optional[JobGroup]:
+        """Smooth weighted round robin over the groups that have a job of the wanted kind and room to run it"""
+        total_weight = 0
+        best = None
+        for group in self._groups.values():
+            if not (group.listings if listings else group.downloads) or not group.can_run():
+                continue
+            group.current_weight += group.weight
+            total_weight += group.weight
+            if best is None or group.current_weight > best.current_weight:
+                best = group
+
+        if best is not None:
+            best.current_weight -= total_weight
+        return best
+
+    def _pop_listing(self) -> Optional[PriorityJob]:
+        group = self._next_group(listings=True) if self._queued_listings else None
+        if group is None:
+            return None
+        self._queued_listings -= 1
+        group.running += 1
+        return heapq.heappop(group.listings)
+
+    def _pop_download(self) -> Optional[PriorityJob]:
+        group = self._next_group(listings=False) if self._queued_downloads else None
+        if group is None:
+            return None
+        self._queued_downloads -= 1
+        self._running_downloads += 1
+        group.running += 1
+        return heapq.heappop(group.downloads)
+
+    def _pop(self) -> Optional[PriorityJob]:
+        job = self._pop_next() if not self.draining else None
+        if job is not None:
+            self.running_jobs += 1
+        return job
+
+    def _pop_next(self) -> Optional[PriorityJob]:
+        pending_downloads = self._queued_downloads + self._running_downloads
+        if self._paused and pending_downloads <= self.low_water:
+            self._paused = False
+        elif not self._paused and pending_downloads >= self.high_water:
+            self._paused = True
+
+        if not self._paused:
+            return self._pop_listing() or self._pop_download()
+        return self._pop_download() or self._pop_listing()
+
+    def _done(self, job: PriorityJob):
+        self.unfinished_jobs -= 1
+        self.running_jobs -= 1
+        self._group(job.group).running -= 1
+        if not self._is_listing(job):
+            self._running_downloads -= 1
+
+    def push(self, job: PriorityJob):
+        with self._lock:
+            self._push(job)
+
+    def pop(self) -> Optional[PriorityJob]:
+        """The next job to run, or None if there's nothing that can run right now"""
+        with self._lock:
+            return self._pop()
+
+    def done(self, job: PriorityJob):
+        """Must be called once for every job returned by pop(), after it has finished (or been re-pushed)"""
+        with self._lock:
+            self._done(job)
+
+    def qsize(self) -> int:
+        return self._queued_listings + self._queued_downloads
+
+    def drain(self):
+        with self._lock:
+            self.draining = True
+
+    def _finished(self) -> bool:
+        return self.unfinished_jobs == 0 or (self.draining and self.running_jobs == 0)
+
+
+class JobQueue(JobScheduler):
+    """JobScheduler with blocking get() and join() for worker threads, like queue.PriorityQueue
+
+       Workers block in get() until there's a job for them, and are told to exit by get() returning None, either to
+       shrink the pool (retire) or when it's closed (shutdown)."""
+
+    def __init__(self, max_queued_downloads: int = 1000):
+        super().__init__(max_queued_downloads)
+        self._condition = Condition(self._lock)
+        self._retiring = 0
+        self._shutdown = False
+
+    def put(self, job: PriorityJob):
+        with self._condition:
+            self._push(job)
+            self._condition.notify()
+
+    def get(self, block: bool = True, timeout: float = None) -> Optional[PriorityJob]:
+        """The next job, or None if the worker calling this should exit.  Raises queue.Empty if there's no job by the
+           timeout (or straight away if not block)"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._condition:
+            while True:
+                if self._shutdown:
+                    return None
+                if self._retiring > 0:
+                    self._retiring -= 1
+                    return None
+
+                job = self._pop()
+                if job is not None:
+                    return job
+
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if not block or (remaining is not None and remaining <= 0):
+                    raise Empty()
+                self._condition.wait(remaining)
+
+    def task_done(self, job: PriorityJob):
+        with self._condition:
+            self._done(job)
+            if self._finished():
+                self._condition.notify_all()
+            else:
+                # a job held back by its group's max_concurrent may be able to run now
+                self._condition.notify()
+
+    def join(self, timeout: float = None) -> bool:
+        """Wait until every job has finished (or when draining, every running job).  Returns False on timeout"""
+        with self._condition:
+            return self._condition.wait_for(self._finished, timeout)
+
+    def drain(self):
+        with self._condition:
+            self.draining = True
+            self._condition.notify_all()
+
+    def retire(self, workers: int):
+        """Make that many workers exit, as soon as each is between jobs"""
+        with self._condition:
+            self._retiring += workers
+            self._condition.notify_all()
+
+    def shutdown(self):
+        """Make every worker exit"""
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
 
 
 class Worker(Thread):
-    def __init__(self, job_queue: PriorityQueue):
+    def __init__(self, job_queue: JobQueue, metrics: Metrics, profiler: Profiler = None):
         super().__init__()
         self.job_queue = job_queue
-        self.is_running = True
+        self.metrics = metrics
+        self.profiler = profiler
 
     def run(self):
-        while self.is_running:
-            try:
-                job = self.job_queue.get(True, 1)
-            except Empty:
-                continue
+        while True:
+            job = self.job_queue.get()
+            if job is None:
+                return
 
+            self.metrics.sample_queue_depth(self.job_queue.qsize())
             try:
-                job.run()
+                job.run(self.metrics, self.profiler)
+            except RequestCancelledException:
+                # stopping, so neither a retry nor a failure.  A download stays pending in its downloader, which
+                # saves it to the checkpoint for the next run
+                pass
+            except RetryableException as e:
+                # requeue before task_done() so the pool can't think it has finished in between
+                self.metrics.record_retry()
+                if job.should_retry():
+                    print('{}  (retry {:d} of {:d})'.format(e, job.retries, JOB_MAX_RETRIES))
+                    self.job_queue.put(job)
+                else:
+                    print('{}  (giving up)'.format(e))
+                    job.failed()
             except Exception as e:
                 print(e)
+                job.failed()
             finally:
-                self.job_queue.task_done()
+                self.job_queue.task_done(job)
+
+
+class Autoscaler:
+    """Hill climbs the number of workers towards the best download throughput
+
+       Keeps adding (or removing) a worker each step while throughput holds up, and turns around when it drops by more
+       than TOLERANCE, e.g. once the disk, the connection or the server's rate limit is the bottleneck instead of the
+       number of workers"""
+
+    TOLERANCE = 0.05
 
-    def stop(self):
-        self.is_running = False
+    def __init__(self, min_workers: int, max_workers: int):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.direction = 1
+        self.last_rate = None  # type: Optional[float]
+
+    def step(self, workers: int, bytes_per_second: float) -> int:
+        """The number of workers to use next, given the throughput seen with workers since the last step"""
+        if self.last_rate is not None and bytes_per_second < self.last_rate * (1 - self.TOLERANCE):
+            self.direction = -self.direction
+        self.last_rate = bytes_per_second
+
+        if not self.min_workers <= workers + self.direction <= self.max_workers:
+            self.direction = -self.direction
+        return max(self.min_workers, min(self.max_workers, workers + self.direction))
 
 
 class ThreadPool:
-    def __init__(self, max_workers: int):
-        self.job_queue = PriorityQueue()
-        self.threads = [Worker(self.job_queue) for _ in range(0, max_workers)]
+    def __init__(self, max_workers: int, session: HttpSession = None, metrics: Metrics = None,
+                 profiler: Profiler = None, max_queued_downloads: int = 1000, disk_writer: DiskWriter = None,
+                 min_workers: int = None):
+        self.job_queue = JobQueue(max_queued_downloads)
+        # one keep-alive session shared by every job, sized so each worker can hold its own open connection
+        self.session = session if session is not None else HttpSession(pool_size=max_workers)
+        self.disk_writer = disk_writer if disk_writer is not None else DiskWriter()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.profiler = profiler
+        self.max_workers = max_workers
 
-    def add_job(self, job: PriorityJob):
+        # with a min_workers the number of workers is adjusted while running, starting from the minimum
+        self.autoscaler = None  # type: Optional[Autoscaler]
+        if min_workers is not None and min_workers < max_workers:
+            self.autoscaler = Autoscaler(min_workers, max_workers)
+        self.workers = 0
+        self.threads = []  # type: List[Worker]
+        self._started = False
+
+    def add_job(self, job: PriorityJob, group: str = None):
+        job.group = group
         self.job_queue.put(job)
 
+    def set_group(self, name: str, weight: int = 1, max_concurrent: int = 0):
+        self.job_queue.set_group(name, weight, max_concurrent)
+
+    def resize(self, workers: int):
+        """Start or retire workers, retired workers finish their current job first"""
+        # forget workers retired by earlier calls once they've exited, or the daemon's list would grow forever
+        self.threads = [worker for worker in self.threads if worker.is_alive()]
+        if workers > self.workers:
+            for _ in range(self.workers, workers):
+                worker = Worker(self.job_queue, self.metrics, self.profiler)
+                worker.start()
+                self.threads.append(worker)
+        elif workers < self.workers:
+            self.job_queue.retire(self.workers - workers)
+        self.workers = workers
+
+    def start(self):
+        """Start the workers, if they aren't already running"""
+        if self._started:
+            return
+        self._started = True
+        self.metrics.start(self.max_workers)
+        self.resize(self.autoscaler.min_workers if self.autoscaler is not None else self.max_workers)
+
+    def wait(self):
+        """Wait for every job to finish, including jobs added by other jobs.  The workers stay running, so more jobs
+           can be added afterwards.  After drain() this returns once the running jobs are done"""
+        if self.autoscaler is None:
+            self.job_queue.join()
+            return
+
+        last_bytes = self.metrics.bytes_downloaded()
+        last_time = time.monotonic()
+        while not self.job_queue.join(AUTOSCALE_INTERVAL):
+            now = time.monotonic()
+            downloaded = self.metrics.bytes_downloaded()
+            workers = self.autoscaler.step(self.workers, (downloaded - last_bytes) / (now - last_time))
+            if workers != self.workers:
+                print('Using {:d} workers'.format(workers))
+                self.resize(workers)
+            last_bytes, last_time = downloaded, now
+
+    @property
+    def interrupted(self) -> bool:
+        return self.job_queue.draining
+
+    def drain(self):
+        """Stop starting jobs, so wait() returns as soon as the running ones finish.  Queued jobs are left queued"""
+        self.job_queue.drain()
+
+    def cancel(self):
+        """drain(), and also abort downloads part way through (keeping what they have to resume from)"""
+        self.drain()
+        self.session.cancel()
+
+    def close(self):
+        self.job_queue.shutdown()
+        [worker.join() for worker in self.threads]
+        self.disk_writer.stop()
+
     def run(self):
-        [worker.start() for worker in self.threads]
-        self.job_queue.join()
-        [worker.stop() for worker in self.threads]
+        self.start()
+        self.wait()
+        self.close()
 
     def __enter__(self):
         return self
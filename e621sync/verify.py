@@ -0,0 +1,76 @@
+import os
+import re
+import mmap
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Iterator, Tuple, Optional
+
+from .globalsettings import PARTIAL_DOWNLOAD_SUFFIX, PARTIAL_METADATA_SUFFIX
+
+# Matches the md5 in all the names we save files as:  {id}_{md5}.{ext}, {index}_{id}_{md5}.{ext} and {md5}.{ext}
+MD5_FILENAME_RE = re.compile(r'(?:^|_)([0-9a-f]{32})\.[^.]+$')
+
+# Matches the post id, and the index for pools, in a rule's file names
+POST_FILENAME_RE = re.compile(r'^(?:(\d+)_)?(\d+)_[0-9a-f]{32}\.[^.]+$')
+
+# size of each read when a file can't be mmap()ed
+READ_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def expected_md5(filename: str) -> Optional[str]:
+    match = MD5_FILENAME_RE.search(os.path.basename(filename))
+    return match.group(1) if match else None
+
+
+def relist_mark(filename: str, pool: bool) -> Optional[int]:
+    """The highest high water mark at which an incremental sync still lists the file's post: just below its post id, or
+       for pools its index.  None for names that aren't a rule's"""
+    match = POST_FILENAME_RE.match(os.path.basename(filename))
+    if match is None or pool != (match.group(1) is not None):
+        return None
+    return int(match.group(1)) if pool else int(match.group(2)) - 1
+
+
+def find_files(directory: str) -> Iterator[str]:
+    """All completed downloads under directory that have an md5 in their name"""
+    if not os.path.isdir(directory):
+        return
+
+    for entry in os.scandir(directory):
+        if entry.is_dir(follow_symlinks=False):
+            yield from find_files(entry.path)
+        elif entry.name.endswith(PARTIAL_DOWNLOAD_SUFFIX) or entry.name.endswith(PARTIAL_METADATA_SUFFIX):
+            continue
+        elif expected_md5(entry.name) is not None:
+            yield entry.path
+
+
+def hash_file(filename: str) -> Tuple[str, Optional[str]]:
+    """Returns (filename, md5), or (filename, None) if the file couldn't be read"""
+    hasher = hashlib.md5()
+    try:
+        with open(filename, 'rb') as f:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    hasher.update(m)
+            except (ValueError, OSError):
+                # empty files (and some file systems) can't be mapped
+                buffer = bytearray(READ_BUFFER_SIZE)
+                view = memoryview(buffer)
+                for size in iter(lambda: f.readinto(buffer), 0):
+                    hasher.update(view[:size])
+    except OSError:
+        return filename, None
+    return filename, hasher.hexdigest()
+
+
+def verify_directories(directories: List[str], processes: int = None) -> Iterator[Tuple[str, str, Optional[str]]]:
+    """Hash every file in directories across a pool of processes.  Yields (filename, expected md5, actual md5) for each
+       file that doesn't match"""
+    filenames = [filename for directory in directories for filename in find_files(directory)]
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for filename, actual in executor.map(hash_file, filenames, chunksize=16):
+            expected = expected_md5(filename)
+            if actual != expected:
+                yield filename, expected, actual
@@ -28,6 +28,23 @@ tags = [ "foobar" ]
 download_directory = "./foo/"
 '''
 
+example_configuration_full_tags = example_configuration_header + '''
+ratings = [ "safe" ]
+
+[rules.rule]
+tags = [ "a", "b", "c", "d", "e" ]
+local_tags = [ "f", "-g" ]
+ratings = [ "safe", "questionable" ]
+download_directory = "./foo/"
+'''
+
+example_configuration_bad_rating = example_configuration_header + '''
+[rules.rule]
+tags = [ "foobar" ]
+ratings = [ "sfw" ]
+download_directory = "./foo/"
+'''
+
 example_configuration_2 = example_configuration_header + '''
 [rules.rule]
 tags = [ "tagme" ]
@@ -70,6 +87,33 @@ class TestConfiguration:
         with pytest.raises(ConfigurationException):
             Configuration._parse_string({'value': 150}, 'value', default='bar')
 
+    def test_parse_number(self):
+        # normal
+        assert Configuration._parse_number({'value': 1.5}, 'value', minimum=0, maximum=2, default=1) == 1.5
+        assert Configuration._parse_number({'value': 2}, 'value', minimum=0, maximum=2, default=1) == 2
+
+        # missing
+        assert Configuration._parse_number({'value': 1.5}, 'missing_value', minimum=0, maximum=2, default=1) == 1
+
+        # out of range
+        with pytest.raises(ConfigurationException):
+            Configuration._parse_number({'value': 2.5}, 'value', minimum=0, maximum=2, default=1)
+
+        # wrong type
+        with pytest.raises(ConfigurationException):
+            Configuration._parse_number({'value': '1.5'}, 'value', minimum=0, maximum=2, default=1)
+
+    def test_parse_bool(self):
+        # normal
+        assert Configuration._parse_bool({'value': True}, 'value', default=False) is True
+
+        # missing
+        assert Configuration._parse_bool({'value': True}, 'missing_value', default=False) is False
+
+        # wrong type
+        with pytest.raises(ConfigurationException):
+            Configuration._parse_bool({'value': 1}, 'value', default=False)
+
     def test_parse_list_of_strings(self):
         # working
         assert Configuration._parse_list_of_strings({'l': ['a', 'b']}, 'l', ['default']) == ['a', 'b']
@@ -109,3 +153,17 @@ class TestConfiguration:
 
         assert r.tags == ['rating:safe', 'tagme', 'score:>2']
         assert r.blacklist_tags == []
+
+    def test_loading_client_side_filters(self):
+        c = Configuration()
+        c.loads(example_configuration_full_tags)
+        r = c.rules[0]
+
+        # no room for the score tag, but it's still checked client side
+        assert r.tags == ['rating:safe', 'a', 'b', 'c', 'd', 'e']
+        assert r.check_minimum_score is True
+        assert r.local_tags == ['f', '-g']
+        assert r.ratings == ['safe', 'questionable']
+
+        with pytest.raises(ConfigurationException):
+            c.loads(example_configuration_bad_rating)
@@ -0,0 +1,71 @@
+import os
+
+from e621sync.dedup import DownloadRegistry, link_file
+from e621sync.stateindex import StateIndex
+
+
+class TestDownloadRegistry:
+    def test_link_file(self, tmpdir):
+        source = str(tmpdir.join('source.png'))
+        with open(source, 'wb') as f:
+            f.write(b'data')
+
+        target = str(tmpdir.join('rule', 'target.png'))
+        link_file(source, target)
+        assert open(target, 'rb').read() == b'data'
+
+        # already there
+        link_file(source, target)
+
+    def test_claim(self, tmpdir):
+        index = StateIndex()
+        registry = DownloadRegistry(index)
+        first = str(tmpdir.join('a', '1_abc.png'))
+        second = str(tmpdir.join('b', '1_abc.png'))
+        third = str(tmpdir.join('c', '1_abc.png'))
+
+        # first claim downloads, second waits for it
+        assert registry.claim('abc', 'png', first, 1, 'a') == first
+        assert registry.claim('abc', 'png', second, 1, 'b') is None
+
+        os.makedirs(os.path.dirname(first))
+        with open(first, 'wb') as f:
+            f.write(b'data')
+        index.add_download(first, 1, 'abc', 'a')
+        registry.complete('abc', first)
+
+        assert open(second, 'rb').read() == b'data'
+        assert index.is_downloaded(second)
+
+        # already downloaded, linked straight away
+        assert registry.claim('abc', 'png', third, 1, 'c') is None
+        assert open(third, 'rb').read() == b'data'
+        assert registry.files_linked == 2
+
+    def test_release(self, tmpdir):
+        registry = DownloadRegistry(StateIndex())
+        first = str(tmpdir.join('a', '1_abc.png'))
+        second = str(tmpdir.join('b', '1_abc.png'))
+        assert registry.claim('abc', 'png', first, 1, 'a') == first
+        assert registry.claim('abc', 'png', second, 1, 'b') is None
+
+        # after a failed download either file can be claimed again
+        registry.release('abc')
+        assert registry.waiting('abc') == []
+        assert registry.claim('abc', 'png', second, 1, 'b') == second
+
+    def test_content_store(self, tmpdir):
+        index = StateIndex()
+        store = str(tmpdir.join('store'))
+        registry = DownloadRegistry(index, store)
+        rule_file = str(tmpdir.join('a', '1_abc.png'))
+
+        store_file = registry.claim('abc', 'png', rule_file, 1, 'a')
+        assert store_file == os.path.join(store, 'ab', 'abc.png')
+
+        os.makedirs(os.path.dirname(store_file))
+        with open(store_file, 'wb') as f:
+            f.write(b'data')
+        registry.complete('abc', store_file)
+
+        assert open(rule_file, 'rb').read() == b'data'
@@ -0,0 +1,72 @@
+import os
+import threading
+
+import pytest
+
+from e621sync.diskwriter import DiskWriter
+
+
+class TestDiskWriter:
+    def test_write(self, tmpdir):
+        writer = DiskWriter(writers=2, buffer_size=256 * 1024)
+        filenames = [str(tmpdir.join('new', 'directory', '{:d}.bin'.format(i))) for i in range(0, 4)]
+        handles = [writer.open(filename) for filename in filenames]
+        for i, handle in enumerate(handles):
+            writer.write(handle, bytes([i]) * 1000)
+            writer.write(handle, b'end')
+
+        for handle in handles:
+            writer.close(handle).result()
+        writer.stop()
+
+        for i, filename in enumerate(filenames):
+            with open(filename, 'rb') as f:
+                assert f.read() == bytes([i]) * 1000 + b'end'
+
+    def test_preallocated_then_append(self, tmpdir):
+        filename = str(tmpdir.join('file.bin'))
+        writer = DiskWriter()
+
+        # the transfer stopped short of the expected size, so the preallocated space has to go
+        handle = writer.open(filename, size=100000)
+        writer.write(handle, b'a' * 100)
+        writer.close(handle).result()
+        assert os.path.getsize(filename) == 100
+
+        handle = writer.open(filename, append=True, size=50)
+        writer.write(handle, b'b' * 50)
+        writer.close(handle).result()
+        writer.stop()
+
+        with open(filename, 'rb') as f:
+            assert f.read() == b'a' * 100 + b'b' * 50
+
+    def test_error(self, tmpdir):
+        # can't create a directory where a file already is
+        tmpdir.join('file').write('')
+        writer = DiskWriter()
+        handle = writer.open(str(tmpdir.join('file', 'file.bin')))
+        writer.write(handle, b'data')
+        with pytest.raises(OSError):
+            writer.close(handle).result()
+        writer.stop()
+
+    def test_close_doesnt_wait_for_other_files(self, tmpdir):
+        writer = DiskWriter(writers=1)
+        other = writer.open(str(tmpdir.join('other.bin')))
+        queue = writer.threads[0].queue
+        started, stuck = threading.Event(), threading.Event()
+        queue.put((lambda thread, _: started.wait(), other, ()))
+
+        handle = writer.open(str(tmpdir.join('file.bin')))
+        writer.write(handle, b'data')
+        done = writer.close(handle)
+        # the other file's next write is stuck behind a slow disk, queued after this file's close
+        queue.put((lambda thread, _: stuck.wait(), other, ()))
+        started.set()
+        try:
+            assert done.result(timeout=5) == str(tmpdir.join('file.bin'))
+        finally:
+            stuck.set()
+        writer.close(other).result()
+        writer.stop()
@@ -0,0 +1,96 @@
+import pytest
+
+from e621sync.downloadposts import DownloadPosts
+from e621sync.diskwriter import DiskWriter
+from e621sync.httpsession import HttpSession
+from e621sync.metrics import Metrics
+from e621sync.rule import Rule
+from e621sync.stateindex import StateIndex
+from e621sync.threadpool import JobQueue
+
+POST_IDS = list(range(10, 0, -1))
+
+
+class RecordingPool:
+    """Just enough of a ThreadPool to construct a DownloadPosts, keeping the jobs so a test can run them in any order"""
+
+    def __init__(self):
+        self.session = HttpSession(pool_size=1)
+        self.disk_writer = DiskWriter()
+        self.metrics = Metrics()
+        self.job_queue = JobQueue()
+        self.jobs = []
+
+    def set_group(self, name, weight=1, max_concurrent=0):
+        pass
+
+    def add_job(self, job, group=None):
+        self.jobs.append(job)
+
+
+class FakeListing(DownloadPosts):
+    """Lists POST_IDS two at a time without a server, and doesn't download anything"""
+
+    def __init__(self, *args, **kwargs):
+        self.listings_fetched = 0
+        super().__init__(*args, **kwargs)
+
+    def get_listing(self, before_id: int = None):
+        self.listings_fetched += 1
+        ids = [post_id for post_id in POST_IDS if before_id is None or post_id < before_id][:self.rule.list_limit]
+        return [{'id': post_id, 'md5': '{:032x}'.format(post_id), 'file_ext': 'png'} for post_id in ids]
+
+    def queue_download(self, item, filename):
+        pass
+
+
+def make_listing(lookahead: int):
+    rule = Rule('test')
+    rule.list_limit = 2
+    rule.listing_lookahead = lookahead
+    pool = RecordingPool()
+    return pool, FakeListing(pool, rule, StateIndex())
+
+
+class TestDownloadPosts:
+    @pytest.mark.parametrize('lookahead', [0, 1, 2])
+    def test_listing_lookahead(self, lookahead):
+        pool, listing = make_listing(lookahead)
+        pages_processed = 0
+        most_outstanding = 0
+
+        def outstanding_pages():
+            """Listing jobs queued or already fetched, whose page hasn't been processed yet"""
+            queued = sum(1 for job in pool.jobs if job.fun == listing.process_rule)
+            return queued + listing.listings_fetched - pages_processed
+
+        # always run listing jobs before processing pages, to get as far ahead as the lookahead allows
+        while pool.jobs:
+            listings = [job for job in pool.jobs if job.fun == listing.process_rule]
+            job = listings[0] if listings else pool.jobs[0]
+            pool.jobs.remove(job)
+            job.run()
+            if job.fun == listing._process_page_job:
+                pages_processed += 1
+            most_outstanding = max(most_outstanding, outstanding_pages())
+
+        assert most_outstanding == lookahead + 1
+
+        # 5 pages of posts, and the empty page that ends the listing
+        assert listing.listings_fetched == 6
+        assert listing.items_found == len(POST_IDS)
+        assert listing.listing_complete()
+
+    def test_deferred_listing(self):
+        pool, listing = make_listing(0)
+        pool.jobs.pop(0).run()
+
+        # with no lookahead the next page isn't fetched until this one has been processed
+        assert [job.fun for job in pool.jobs] == [listing._process_page_job]
+        assert listing._deferred_listing == 9
+
+        pool.jobs.pop(0).run()
+        assert [job.fun for job in pool.jobs] == [listing.process_rule]
+        assert pool.jobs[0].args == (9,)
+        assert listing._deferred_listing is None
+        assert not listing.listing_complete()
@@ -0,0 +1,102 @@
+import os
+import hashlib
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from e621sync.filedownloader import FileDownloader, ChecksumException
+from e621sync.httpsession import HttpSession, RetryableException
+
+FILE_DATA = bytes(range(0, 256)) * 1024
+FILE_MD5 = hashlib.md5(FILE_DATA).hexdigest()
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves FILE_DATA with an ETag and Range support.  Cuts the connection half way if the server's truncate flag is
+       set"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        start = 0
+        if 'Range' in self.headers and self.headers.get('If-Range') == '"v1"':
+            start = int(self.headers['Range'][len('bytes='):].rstrip('-'))
+
+        body = FILE_DATA[start:]
+        self.send_response(206 if start else 200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if self.server.truncate:
+            self.server.truncate = False
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = HTTPServer(('127.0.0.1', 0), RangeHandler)
+    server.requests = []
+    server.truncate = False
+    server.url = 'http://127.0.0.1:{:d}/file.png'.format(server.server_port)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestFileDownloader:
+    def test_download(self, server, tmpdir):
+        filename = str(tmpdir.join('rule', 'file.png'))
+        downloader = FileDownloader(HttpSession(pool_size=1))
+        assert downloader.download(server.url, filename, FILE_MD5) == len(FILE_DATA)
+        assert open(filename, 'rb').read() == FILE_DATA
+        assert os.listdir(str(tmpdir.join('rule'))) == ['file.png']
+
+    def test_resume(self, server, tmpdir):
+        filename = str(tmpdir.join('file.png'))
+        downloader = FileDownloader(HttpSession(pool_size=1))
+
+        server.truncate = True
+        with pytest.raises(RetryableException):
+            downloader.download(server.url, filename, FILE_MD5)
+        assert not os.path.exists(filename)
+        assert os.path.getsize(filename + '.part') == len(FILE_DATA) // 2
+
+        # second attempt only fetches the missing half
+        assert downloader.download(server.url, filename, FILE_MD5) == len(FILE_DATA) - len(FILE_DATA) // 2
+        assert server.requests[-1]['Range'] == 'bytes={:d}-'.format(len(FILE_DATA) // 2)
+        assert open(filename, 'rb').read() == FILE_DATA
+        assert os.listdir(str(tmpdir)) == ['file.png']
+
+    def test_resume_preallocated(self, server, tmpdir):
+        filename = str(tmpdir.join('file.png'))
+        downloader = FileDownloader(HttpSession(pool_size=1))
+
+        server.truncate = True
+        with pytest.raises(RetryableException):
+            downloader.download(server.url, filename, FILE_MD5)
+
+        # a crash part way through the next attempt leaves the .part file at its preallocated size, with the offset
+        # from the first attempt still recorded
+        os.truncate(filename + '.part', len(FILE_DATA))
+        assert downloader.download(server.url, filename, FILE_MD5) == len(FILE_DATA) - len(FILE_DATA) // 2
+        assert server.requests[-1]['Range'] == 'bytes={:d}-'.format(len(FILE_DATA) // 2)
+        assert open(filename, 'rb').read() == FILE_DATA
+
+    def test_checksum(self, server, tmpdir):
+        filename = str(tmpdir.join('file.png'))
+        downloader = FileDownloader(HttpSession(pool_size=1))
+        with pytest.raises(ChecksumException):
+            downloader.download(server.url, filename, 'not the md5')
+        assert os.listdir(str(tmpdir)) == []
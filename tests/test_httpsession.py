@@ -0,0 +1,43 @@
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from e621sync.httpsession import HttpSession
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'{"success": true}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server_url():
+    server = HTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:{:d}/'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+class TestHttpSession:
+    def test_connections_reused(self, server_url):
+        session = HttpSession(pool_size=2)
+        for _ in range(0, 5):
+            assert session.get(server_url).json() == {'success': True}
+
+        assert session.connections_opened == 1
+        assert session.connections_reused == 4
+        session.close()
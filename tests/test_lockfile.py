@@ -0,0 +1,15 @@
+import pytest
+
+from e621sync.lockfile import LockFile, LockFileException
+
+
+class TestLockFile:
+    def test_lock(self, tmpdir):
+        filename = str(tmpdir.join('e621sync.lock'))
+        with LockFile(filename):
+            with pytest.raises(LockFileException):
+                LockFile(filename).acquire()
+
+        # released, so can be locked again
+        with LockFile(filename):
+            pass
@@ -0,0 +1,43 @@
+from e621sync.metadatastore import MetadataStore
+
+
+def post(post_id: int, tags: str, score: int = 0):
+    return {'id': post_id, 'md5': '{:032x}'.format(post_id), 'file_ext': 'png', 'file_size': 1024, 'width': 64,
+            'height': 64, 'score': score, 'rating': 's', 'tags': tags}
+
+
+class TestMetadataStore:
+    def test_query(self):
+        store = MetadataStore()
+        store.add_posts([post(1, 'wolf solo'), post(2, 'wolf duo comic'), post(3, 'fox solo')])
+
+        assert store.query(['wolf']) == [2, 1]
+        assert store.query(['wolf', 'solo']) == [1]
+        assert store.query(['solo', '-fox']) == [1]
+        assert store.query(['-comic']) == [3, 1]
+        assert store.query(['-unknown']) == [3, 2, 1]
+        assert store.query(['unknown']) == []
+        assert store.query([], limit=1) == [3]
+
+    def test_update(self):
+        store = MetadataStore()
+        store.add_posts([post(1, 'wolf solo', 5)])
+        # listed again after a tag edit
+        store.add_posts([post(1, 'fox solo', 10)])
+
+        assert store.query(['wolf']) == []
+        assert store.query(['fox']) == [1]
+        assert store.get_post(1)['tags'] == 'fox solo'
+        assert store.get_post(1)['score'] == 10
+        assert store.get_post(2) is None
+
+    def test_persistence(self, tmpdir):
+        filename = str(tmpdir.join('metadata.sqlite'))
+        store = MetadataStore(filename)
+        store.add_posts([post(1, 'wolf solo')])
+        store.close()
+
+        store = MetadataStore(filename)
+        store.add_posts([post(2, 'wolf duo')])
+        assert store.query(['wolf']) == [2, 1]
+        store.close()
@@ -0,0 +1,82 @@
+import json
+import threading
+
+import pytest
+
+from e621sync import metrics
+from e621sync.metrics import Histogram, Metrics, Profiler
+
+
+class TestMetrics:
+    def test_histogram(self):
+        h = Histogram(buckets=(1.0, 2.0))
+        for value in (0.5, 1.0, 1.5, 3.0):
+            h.observe(value)
+        assert h.counts == [2, 1, 1]
+        assert h.count == 4
+        assert h.sum == 6.0
+
+    def test_summary(self, tmpdir):
+        m = Metrics()
+        m.start(workers=2)
+        m.record_request('api', 0.2)
+        m.record_download('rule', 2048, 2.0)
+        m.record_download('rule', 2048, 2.0)
+        m.record_retry()
+        m.record_job(1.0)
+        m.sample_queue_depth(10)
+        m.sample_queue_depth(5)  # too soon after the last sample
+
+        summary = m.summary()
+        assert summary['requests']['api']['count'] == 1
+        assert summary['rules']['rule'] == {'files': 2, 'bytes': 4096, 'seconds': 4.0, 'bytes_per_second': 1024}
+        assert summary['retries'] == 1
+        assert len(summary['queue_depth']) == 1
+
+        m.write_json(str(tmpdir.join('metrics.json')))
+        assert json.loads(tmpdir.join('metrics.json').read())['jobs'] == 1
+
+        m.write_prometheus(str(tmpdir.join('metrics.prom')))
+        prometheus = tmpdir.join('metrics.prom').read()
+        assert 'e621sync_request_seconds_bucket{kind="api",le="0.25"} 1' in prometheus
+        assert 'e621sync_downloaded_bytes_total{rule="rule"} 4096' in prometheus
+
+    def test_queue_depth_limit(self, monkeypatch):
+        monkeypatch.setattr(metrics, 'QUEUE_DEPTH_INTERVAL', 0)
+        m = Metrics()
+        for depth in range(0, metrics.QUEUE_DEPTH_SAMPLES + 10):
+            m.sample_queue_depth(depth)
+
+        # only the newest samples are kept
+        queue_depth = m.summary()['queue_depth']
+        assert len(queue_depth) == metrics.QUEUE_DEPTH_SAMPLES
+        assert queue_depth[-1][1] == metrics.QUEUE_DEPTH_SAMPLES + 9
+
+    def test_profiler(self, tmpdir):
+        p = Profiler()
+        assert p.run(sum, [1, 2, 3]) == 6
+        p.write(str(tmpdir.join('profile')))
+        assert tmpdir.join('profile').check()
+
+    @pytest.mark.parametrize('process_wide', [
+        pytest.param(False, marks=pytest.mark.skipif(metrics.PROCESS_WIDE_PROFILER,
+                                                     reason='only one profiler can be active')),
+        True])
+    def test_profiler_threads(self, tmpdir, monkeypatch, process_wide):
+        monkeypatch.setattr(metrics, 'PROCESS_WIDE_PROFILER', process_wide)
+        p = Profiler()
+        # every thread is inside run() at the same time
+        barrier = threading.Barrier(4)
+        results = []
+
+        def job(value):
+            barrier.wait(timeout=5)
+            return value * 2
+
+        threads = [threading.Thread(target=lambda value=value: results.append(p.run(job, value))) for value in range(4)]
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+        assert sorted(results) == [0, 2, 4, 6]
+
+        p.write(str(tmpdir.join('profile')))
+        assert tmpdir.join('profile').check()
@@ -0,0 +1,54 @@
+import time
+import threading
+
+from e621sync.ratelimit import RateLimiter
+from e621sync.httpsession import HttpSession
+
+
+class TestRateLimiter:
+    def test_rate(self):
+        limiter = RateLimiter(rate=50, burst=1)
+        start = time.monotonic()
+        for _ in range(0, 6):
+            limiter.acquire()
+        # first token is free, the other 5 need 1/50th of a second each
+        assert time.monotonic() - start >= 0.09
+
+    def test_unlimited(self):
+        limiter = RateLimiter(rate=0)
+        start = time.monotonic()
+        for _ in range(0, 1000):
+            limiter.acquire()
+        assert time.monotonic() - start < 0.5
+
+    def test_backoff(self):
+        limiter = RateLimiter(rate=0)
+        assert limiter.backoff(retry_after=0.1) == 0.1
+        start = time.monotonic()
+        limiter.acquire()
+        assert time.monotonic() - start >= 0.09
+
+        # without a Retry-After the delay grows with each failure, but is reset by a success
+        limiter.success()
+        limiter.BACKOFF_BASE = 0.001
+        delays = [limiter.backoff() for _ in range(0, 4)]
+        assert all(limiter.BACKOFF_BASE <= delay <= limiter.BACKOFF_BASE * 16 for delay in delays)
+        limiter.success()
+        assert limiter.backoff() <= limiter.BACKOFF_BASE * 2
+
+    def test_cancel(self):
+        limiter = RateLimiter(rate=0)
+        # a huge Retry-After is capped, and waiting for it can be cancelled
+        assert limiter.backoff(retry_after=3600) == limiter.BACKOFF_MAX
+        timer = threading.Timer(0.1, limiter.cancelled.set)
+        timer.start()
+        start = time.monotonic()
+        assert limiter.acquire() is False
+        assert time.monotonic() - start < 5
+        timer.join()
+
+    def test_parse_retry_after(self):
+        assert HttpSession._parse_retry_after(None) is None
+        assert HttpSession._parse_retry_after('5') == 5.0
+        assert HttpSession._parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0.0
+        assert HttpSession._parse_retry_after('soon') is None
@@ -0,0 +1,44 @@
+import time
+
+from e621sync.responsecache import ResponseCache
+
+
+class TestResponseCache:
+    def test_get_put(self):
+        cache = ResponseCache(ttl=60)
+        key = cache.key('https://e621.net/post/index.json', {'tags': 'a', 'limit': '100'})
+        assert key == cache.key('https://e621.net/post/index.json', {'limit': '100', 'tags': 'a'})
+        assert cache.get(key) is None
+
+        cache.put(key, b'[]', '"etag"')
+        cached = cache.get(key)
+        assert cached.body == b'[]'
+        assert cached.etag == '"etag"'
+        assert cache.is_fresh(cached)
+        assert cache.hits == 1
+
+    def test_ttl(self):
+        cache = ResponseCache(ttl=0)
+        cache.put('key', b'[]')
+        assert not cache.is_fresh(cache.get('key'))
+
+    def test_eviction(self):
+        cache = ResponseCache(max_size=250)
+        for key in ('a', 'b', 'c'):
+            cache.put(key, b'x' * 100)
+            time.sleep(0.01)
+
+        # 'a' is the least recently used, so goes first
+        assert cache.get('a') is None
+        assert cache.get('b') is not None
+        assert cache.size == 200
+
+    def test_persistence(self, tmpdir):
+        filename = str(tmpdir.join('cache.sqlite'))
+        cache = ResponseCache(filename)
+        cache.put('key', b'[1, 2, 3]')
+        cache.close()
+
+        cache = ResponseCache(filename)
+        assert cache.get('key').body == b'[1, 2, 3]'
+        assert cache.size == 9
@@ -22,6 +22,10 @@ class TestRule:
         rule.blacklist_tags = ['foo', 'bar', 'baz']
         assert rule.has_blacklisted_tag(['baz']) is True
 
+        # changing the list in place counts too
+        rule.blacklist_tags.append('qux')
+        assert rule.has_blacklisted_tag(['qux']) is True
+
     def test_get_pool_id(self):
         rule = Rule('test rule')
         rule.tags = ['foo', 'bar']
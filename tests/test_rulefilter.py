@@ -0,0 +1,54 @@
+from e621sync.rule import Rule
+from e621sync.rulefilter import RuleFilter
+
+
+def make_item(**kwargs):
+    item = {'id': 1, 'tags': 'foo bar', 'score': 10, 'rating': 's', 'file_ext': 'png', 'file_size': 1000}
+    item.update(kwargs)
+    return item
+
+
+class TestRuleFilter:
+    def test_blacklist(self):
+        rule = Rule('test rule')
+        rule.blacklist_tags = ['duck']
+        f = RuleFilter(rule)
+        assert f.matches(make_item()) is True
+        assert f.matches(make_item(tags='foo duck')) is False
+
+    def test_local_tags(self):
+        rule = Rule('test rule')
+        rule.local_tags = ['foo', '-comic']
+        f = RuleFilter(rule)
+        assert f.matches(make_item()) is True
+        assert f.matches(make_item(tags='bar')) is False
+        assert f.matches(make_item(tags='foo comic')) is False
+
+    def test_minimum_score(self):
+        rule = Rule('test rule')
+        rule.minimum_score = 10
+        assert RuleFilter(rule).matches(make_item(score=5)) is True
+
+        # same as the server's score:>N
+        rule.check_minimum_score = True
+        f = RuleFilter(rule)
+        assert f.matches(make_item(score=11)) is True
+        assert f.matches(make_item(score=10)) is False
+
+    def test_fields(self):
+        rule = Rule('test rule')
+        rule.ratings = ['safe', 'q']
+        rule.file_extensions = ['png', 'jpg']
+        rule.max_file_size = 2000
+        f = RuleFilter(rule)
+        assert f.matches(make_item()) is True
+        assert f.matches(make_item(rating='q')) is True
+        assert f.matches(make_item(rating='e')) is False
+        assert f.matches(make_item(file_ext='webm')) is False
+        assert f.matches(make_item(file_size=3000)) is False
+
+    def test_filter_page(self):
+        rule = Rule('test rule')
+        rule.blacklist_tags = ['duck']
+        items = [make_item(id=1), make_item(id=2, tags='duck'), make_item(id=3)]
+        assert [item['id'] for item in RuleFilter(rule).filter_page(items)] == [1, 3]
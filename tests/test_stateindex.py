@@ -0,0 +1,42 @@
+from e621sync.stateindex import StateIndex
+
+
+class TestStateIndex:
+    def test_downloads(self):
+        index = StateIndex()
+        assert index.is_downloaded('./foo/1_abc.png') is False
+        assert index.find_by_md5('abc') is None
+
+        index.add_download('./foo/1_abc.png', 1, 'abc', 'rule')
+        assert index.is_downloaded('./foo/1_abc.png') is True
+        assert index.find_by_md5('abc') == './foo/1_abc.png'
+        assert index.get_filenames(1) == ['./foo/1_abc.png']
+        assert index.get_all_filenames() == ['./foo/1_abc.png']
+
+        index.remove_download('./foo/1_abc.png')
+        assert index.is_downloaded('./foo/1_abc.png') is False
+
+    def test_high_water_mark(self):
+        index = StateIndex()
+        assert index.get_high_water_mark('rule') is None
+        index.update_high_water_mark('rule', 100)
+        assert index.get_high_water_mark('rule') == 100
+
+        # never goes backwards
+        index.update_high_water_mark('rule', 50)
+        assert index.get_high_water_mark('rule') == 100
+
+        # unless asked to
+        index.lower_high_water_mark('rule', 50)
+        index.lower_high_water_mark('rule', 75)
+        assert index.get_high_water_mark('rule') == 50
+
+    def test_persistence(self, tmpdir):
+        filename = str(tmpdir.join('state.sqlite'))
+        index = StateIndex(filename)
+        index.add_download('./foo/1_abc.png', 1, 'abc', 'rule')
+        index.close()
+
+        index = StateIndex(filename)
+        assert index.is_downloaded('./foo/1_abc.png') is True
+        index.close()
@@ -0,0 +1,366 @@
+import os
+import sys
+import signal
+import threading
+import subprocess
+import importlib.util
+
+import pytest
+
+from benchmarks.mockserver import MockCatalog, MockE621Server, POOL_ID
+from e621sync.configuration import Configuration
+from e621sync.rule import Rule
+from e621sync.downloadposts import DownloadPosts
+from e621sync.stateindex import StateIndex
+from e621sync.metadatastore import MetadataStore
+from e621sync.lockfile import LockFile
+from e621sync.plan import SyncPlan
+from e621sync.globalsettings import JOB_MAX_RETRIES
+
+# e621sync.py is shadowed by the e621sync package, so load the script by path
+spec = importlib.util.spec_from_file_location('e621sync_script', os.path.join(os.path.dirname(__file__), '..',
+                                                                               'e621sync.py'))
+e621sync_script = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(e621sync_script)
+
+
+@pytest.fixture
+def server():
+    server = MockE621Server(MockCatalog(posts=120, file_size=1024, pool_size=30)).start()
+    yield server
+    server.stop()
+
+
+def make_rules(tmpdir):
+    posts = Rule('posts')
+    posts.tags = ['mock']
+    posts.list_limit = 50
+    posts.download_directory = str(tmpdir.join('posts'))
+
+    pool = Rule('pool')
+    pool.tags = ['pool:{:d}'.format(POOL_ID)]
+    pool.download_directory = str(tmpdir.join('pool'))
+    return [posts, pool]
+
+
+def make_config(tmpdir, server, rules=None, **settings):
+    """A Configuration for the mock server, without rate limits or a checkpoint file unless they're in settings"""
+    config = Configuration()
+    config.rules = rules if rules is not None else make_rules(tmpdir)
+    config.api_url = server.url
+    config.api_rate_limit = 0
+    config.cdn_rate_limit = 0
+    config.checkpoint_file = None
+    for name, value in settings.items():
+        setattr(config, name, value)
+    return config
+
+
+class TestSync:
+    def test_sync(self, server, tmpdir):
+        config = make_config(tmpdir, server, state_file=str(tmpdir.join('state.sqlite')))
+        rules = config.rules
+        e621sync_script.sync(config)
+
+        assert len(os.listdir(rules[0].download_directory)) == 120
+        assert len(os.listdir(rules[1].download_directory)) == 30
+        assert sorted(os.listdir(rules[1].download_directory))[0].startswith('0000_1_')
+
+        # pool posts are also matched by the posts rule, so are only downloaded once
+        assert server.reset_counters()['files'] == 120
+
+        # nothing new, so an incremental run only needs the first page of each rule
+        config.incremental = True
+        e621sync_script.sync(config)
+        counters = server.reset_counters()
+        assert counters['files'] == 0
+        assert counters['api'] <= 3
+
+    def test_incremental_after_failed_downloads(self, server, tmpdir):
+        state_file = str(tmpdir.join('state.sqlite'))
+        config = make_config(tmpdir, server, state_file=state_file)
+        rules = config.rules
+        # 60 is only in the posts rule, 11 is the pool's 11th post and in the posts rule too
+        server.failing_files[60] = JOB_MAX_RETRIES + 1
+        server.failing_files[11] = JOB_MAX_RETRIES + 1
+        e621sync_script.sync(config)
+        assert len(os.listdir(rules[0].download_directory)) == 118
+
+        # the marks stop short of the failed posts, so the next incremental sync goes back for them
+        state_index = StateIndex(state_file)
+        assert state_index.get_high_water_mark('posts') == 10
+        assert state_index.get_high_water_mark('pool') == 10
+        state_index.close()
+
+        server.reset_counters()
+        config.incremental = True
+        e621sync_script.sync(config)
+        assert server.reset_counters()['files'] == 2
+        assert len(os.listdir(rules[0].download_directory)) == 120
+        assert len(os.listdir(rules[1].download_directory)) == 30
+
+    def test_verify_repair(self, server, tmpdir):
+        state_file = str(tmpdir.join('state.sqlite'))
+        config = make_config(tmpdir, server, state_file=state_file)
+        rules = config.rules
+        e621sync_script.sync(config)
+
+        # post 60 is only in the posts rule, post 6 is the pool's index 5 and linked into the posts rule too
+        bad_files = [os.path.join(rule.download_directory, name) for rule, prefix in zip(rules, ('60_', '0005_6_'))
+                     for name in os.listdir(rule.download_directory) if name.startswith(prefix)]
+        for filename in bad_files:
+            with open(filename, 'r+b') as f:
+                f.write(b'corrupt')
+
+        assert e621sync_script.verify(rules, state_file, repair=True) == 3
+        state_index = StateIndex(state_file)
+        assert state_index.get_high_water_mark('posts') == 5
+        assert state_index.get_high_water_mark('pool') == 5
+        state_index.close()
+
+        # even an incremental sync lists back far enough to download them again
+        server.reset_counters()
+        config.incremental = True
+        e621sync_script.sync(config)
+        assert server.reset_counters()['files'] == 2
+        assert e621sync_script.verify(rules, state_file) == 0
+        assert len(os.listdir(rules[0].download_directory)) == 120
+        assert len(os.listdir(rules[1].download_directory)) == 30
+
+    def test_missing_file(self, server, tmpdir):
+        config = make_config(tmpdir, server, state_file=str(tmpdir.join('state.sqlite')))
+        rules = config.rules
+        e621sync_script.sync(config)
+        missing = [os.path.join(rules[0].download_directory, name)
+                   for name in os.listdir(rules[0].download_directory) if name.startswith(('60_', '100_'))]
+        for filename in missing:
+            os.remove(filename)
+
+        # a full sync doesn't trust the index, it checks the disk
+        server.reset_counters()
+        e621sync_script.sync(config)
+        assert server.reset_counters()['files'] == 2
+        assert all(os.path.exists(filename) for filename in missing)
+
+        # an incremental sync does trust the index, so verify has to forget the missing files first
+        for filename in missing:
+            os.remove(filename)
+        assert e621sync_script.verify(rules, config.state_file) == 2
+        assert e621sync_script.verify(rules, config.state_file) == 0
+        config.incremental = True
+        e621sync_script.sync(config)
+        assert server.reset_counters()['files'] == 2
+        assert all(os.path.exists(filename) for filename in missing)
+
+    def test_failed_page(self, server, tmpdir, monkeypatch):
+        process_page = DownloadPosts.process_page
+
+        def failing_process_page(downloader, items):
+            if any(item['id'] == 60 for item in items):
+                raise ValueError('broken page')
+            process_page(downloader, items)
+
+        monkeypatch.setattr(DownloadPosts, 'process_page', failing_process_page)
+        state_file = str(tmpdir.join('state.sqlite'))
+        e621sync_script.sync(make_config(tmpdir, server, make_rules(tmpdir)[:1], state_file=state_file))
+
+        state_index = StateIndex(state_file)
+        assert state_index.get_high_water_mark('posts') is None
+        state_index.close()
+
+    def test_pool_pages(self, tmpdir):
+        catalog = MockCatalog(posts=100, file_size=64, pool_size=100, pool_post_ids=True)
+        # the pool's order isn't the same as post id order, so positions have to come from post_ids
+        catalog.pool.reverse()
+        server = MockE621Server(catalog).start()
+        try:
+            pool = make_rules(tmpdir)[1]
+            config = make_config(tmpdir, server, [pool], state_file=str(tmpdir.join('state.sqlite')))
+            e621sync_script.sync(config)
+
+            filenames = sorted(os.listdir(pool.download_directory))
+            assert len(filenames) == 100
+            assert filenames[0].startswith('0000_100_')
+            assert filenames[-1].startswith('0099_1_')
+            assert server.reset_counters()['api'] == 5
+
+            # already fully synced, so only the first page is needed
+            config.incremental = True
+            e621sync_script.sync(config)
+            assert server.reset_counters()['api'] == 1
+        finally:
+            server.stop()
+
+    @pytest.mark.parametrize('pool_size, post_ids, incremental_api_calls', [(100, True, 1), (100, False, 2),
+                                                                            (96, False, 2)])
+    def test_pool_without_post_count(self, tmpdir, pool_size, post_ids, incremental_api_calls):
+        catalog = MockCatalog(posts=pool_size, file_size=64, pool_size=pool_size, pool_post_ids=post_ids,
+                              pool_post_count=False)
+        server = MockE621Server(catalog).start()
+        try:
+            pool = make_rules(tmpdir)[1]
+            config = make_config(tmpdir, server, [pool], state_file=str(tmpdir.join('state.sqlite')))
+            e621sync_script.sync(config)
+
+            # the size comes from post_ids, or pages are fetched until a short (or empty) one
+            assert len(os.listdir(pool.download_directory)) == pool_size
+            assert server.reset_counters()['api'] == 5
+            state_index = StateIndex(config.state_file)
+            assert state_index.get_high_water_mark('pool') == pool_size
+            state_index.close()
+
+            # incremental syncs can still skip to the last page
+            config.incremental = True
+            e621sync_script.sync(config)
+            assert server.reset_counters()['api'] == incremental_api_calls
+        finally:
+            server.stop()
+
+    def test_daemon(self, server, tmpdir):
+        rules = make_rules(tmpdir)
+        for rule in rules:
+            rule.poll_interval = 0
+        e621sync_script.daemon(make_config(tmpdir, server, rules), max_polls=3)
+
+        assert len(os.listdir(rules[0].download_directory)) == 120
+        counters = server.reset_counters()
+        assert counters['files'] == 120
+
+        # the first poll lists everything (posts ends on an empty page), after that each rule needs one request a poll
+        assert counters['api'] == 4 + 2 + 2 * 2
+
+    def test_daemon_failed_download(self, server, tmpdir):
+        rules = make_rules(tmpdir)[:1]
+        rules[0].poll_interval = 0
+        # the newest post fails every attempt of the first poll, then the CDN recovers
+        server.failing_files[120] = JOB_MAX_RETRIES + 1
+        e621sync_script.daemon(make_config(tmpdir, server, rules), max_polls=2)
+
+        assert len(os.listdir(rules[0].download_directory)) == 120
+        assert server.reset_counters()['errors'] == JOB_MAX_RETRIES + 1
+
+    def test_listing_cache(self, server, tmpdir):
+        config = make_config(tmpdir, server, listing_cache=str(tmpdir.join('cache.sqlite')), listing_cache_ttl=3600)
+        e621sync_script.sync(config)
+        assert server.reset_counters()['api'] == 6
+
+        # everything listed is still fresh
+        e621sync_script.sync(config)
+        assert server.reset_counters()['api'] == 0
+
+        # without a ttl every page is revalidated, but nothing has changed
+        config.listing_cache_ttl = 0
+        e621sync_script.sync(config)
+        counters = server.reset_counters()
+        assert counters['api'] == 6
+        assert counters['not_modified'] == 6
+
+    def test_metadata_store(self, server, tmpdir, capsys):
+        state_file = str(tmpdir.join('state.sqlite'))
+        metadata_file = str(tmpdir.join('metadata.sqlite'))
+        config = make_config(tmpdir, server, state_file=state_file, metadata_store=metadata_file)
+        rules = config.rules
+        e621sync_script.sync(config)
+        server.reset_counters()
+        capsys.readouterr()
+
+        # searching is local, and prints the downloaded files
+        post_ids = e621sync_script.query(['mock'], metadata_file, state_file)
+        assert len(post_ids) == 120
+        assert server.reset_counters()['api'] == 0
+        assert os.path.join(rules[0].download_directory, '120_') in capsys.readouterr().out
+
+    def test_query_command(self, tmpdir):
+        metadata_file = str(tmpdir.join('metadata.sqlite'))
+        store = MetadataStore(metadata_file)
+        store.add_posts([{'id': post_id, 'md5': '{:032x}'.format(post_id), 'file_ext': 'png', 'tags': tags}
+                         for post_id, tags in ((1, 'wolf solo'), (2, 'wolf solo comic'), (3, 'wolf hairy'))])
+        store.close()
+
+        config_file = tmpdir.join('config.toml')
+        config_file.write('metadata_store = "{}"\nlock_file = "{}"\n[rules.wolf]\ntags = ["wolf"]\n'
+                          'download_directory = "{}"\n'.format(metadata_file, tmpdir.join('sync.lock'),
+                                                                tmpdir.join('wolf')))
+
+        script = os.path.join(os.path.dirname(__file__), '..', 'e621sync.py')
+
+        def run(*args):
+            return subprocess.run([sys.executable, script, '--config', str(config_file)] + list(args),
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+        # searching only reads, so it works while a sync holds the lock
+        lock_file = LockFile(str(tmpdir.join('sync.lock')))
+        lock_file.acquire()
+        try:
+            # tags can come either side of --not
+            assert run('query', 'wolf', '--not', 'comic', 'solo').stdout.split() == ['1']
+            assert run('query', '--not', 'comic', 'wolf').stdout.split() == ['3', '1']
+            assert run('query', 'wolf', '--not', 'hairy').stdout.split() == ['2', '1']
+
+            # -hairy isn't -h with an argument
+            result = run('query', 'wolf', '-hairy')
+            assert result.returncode == 2
+            assert '--not TAG' in result.stderr
+
+            # everything else still waits its turn
+            assert 'already running' in run('verify').stdout
+        finally:
+            lock_file.release()
+
+    def test_plan(self, server, tmpdir):
+        state_file = str(tmpdir.join('state.sqlite'))
+        plan_file = str(tmpdir.join('plan.json'))
+        config = make_config(tmpdir, server, state_file=state_file)
+        rules = config.rules
+        plan = SyncPlan()
+        e621sync_script.sync(config, plan=plan)
+        plan.save(plan_file)
+
+        # the pool's posts are also in the posts rule, so only one copy of each is counted as new
+        summary = plan.summary()
+        assert summary['posts']['new'] + summary['pool']['new'] == 120
+        assert summary['posts']['linked'] + summary['pool']['linked'] == 30
+        assert summary['posts']['bytes'] + summary['pool']['bytes'] == 120 * 1024
+        assert server.reset_counters()['files'] == 0
+        assert not os.path.exists(rules[0].download_directory)
+
+        e621sync_script.sync(config, from_plan=SyncPlan.load(plan_file))
+        counters = server.reset_counters()
+        assert counters['api'] == 0
+        assert counters['files'] == 120
+        assert len(os.listdir(rules[0].download_directory)) == 120
+        assert len(os.listdir(rules[1].download_directory)) == 30
+
+        # everything in the plan is now downloaded
+        plan = SyncPlan()
+        e621sync_script.sync(config, plan=plan)
+        assert plan.summary()['posts'] == {'new': 0, 'existing': 120, 'linked': 0, 'bytes': 0}
+
+    def test_interrupted(self, tmpdir):
+        # slow enough that the downloads are still going when the signals arrive
+        server = MockE621Server(MockCatalog(posts=40, file_size=64 * 1024), bandwidth=256 * 1024).start()
+        try:
+            checkpoint_file = str(tmpdir.join('checkpoint.json'))
+            config = make_config(tmpdir, server, make_rules(tmpdir)[:1], max_workers=2,
+                                 state_file=str(tmpdir.join('state.sqlite')), checkpoint_file=checkpoint_file)
+            rules = config.rules
+
+            def interrupt():
+                os.kill(os.getpid(), signal.SIGINT)
+                os.kill(os.getpid(), signal.SIGINT)
+            timer = threading.Timer(0.5, interrupt)
+            timer.start()
+            e621sync_script.sync(config)
+            timer.join()
+
+            saved = SyncPlan.load(checkpoint_file).download_count()
+            assert 0 < saved < 40
+            assert len([name for name in os.listdir(rules[0].download_directory) if name.endswith('.png')]) < 40
+
+            # the next run picks up where it left off, and the checkpoint goes once it's done
+            config.max_workers = 4
+            e621sync_script.sync(config)
+            assert len([name for name in os.listdir(rules[0].download_directory) if name.endswith('.png')]) == 40
+            assert not os.path.exists(checkpoint_file)
+        finally:
+            server.stop()
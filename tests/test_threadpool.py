@@ -1,4 +1,10 @@
-from e621sync.threadpool import ThreadPool, LowPriorityJob, HighPriorityJob
+import time
+import pytest
+from queue import Empty
+
+from e621sync.threadpool import ThreadPool, LowPriorityJob, HighPriorityJob, JobScheduler, JobQueue, Autoscaler
+from e621sync.httpsession import RetryableException, RequestCancelledException
+from e621sync.globalsettings import JOB_MAX_RETRIES
 
 
 class TestThreadPool:
@@ -12,3 +18,169 @@ class TestThreadPool:
         with ThreadPool(2) as thread_pool:
             thread_pool.add_job(LowPriorityJob(print))
             pass
+
+    def test_scheduler_back_pressure(self):
+        scheduler = JobScheduler(max_queued_downloads=4)
+        listings = [HighPriorityJob(print, i) for i in range(0, 3)]
+        downloads = [LowPriorityJob(print, i) for i in range(0, 6)]
+
+        scheduler.push(listings[0])
+        scheduler.push(listings[1])
+        for job in downloads[:4]:
+            scheduler.push(job)
+
+        # too many downloads waiting, so they go first even though listings are higher priority
+        popped = [scheduler.pop() for _ in range(0, 3)]
+        assert all(job in downloads for job in popped)
+        [scheduler.done(job) for job in popped]
+
+        # drained to the low water mark, listings can run again
+        assert scheduler.pop() in listings
+        assert scheduler.unfinished_jobs == 3
+
+    def test_job_queue(self):
+        job_queue = JobQueue()
+        job = HighPriorityJob(print)
+        job_queue.put(job)
+        assert job_queue.qsize() == 1
+        assert job_queue.get() is job
+        with pytest.raises(Empty):
+            job_queue.get(timeout=0.01)
+        job_queue.task_done(job)
+        job_queue.join()
+
+    def test_scheduler_fifo_within_priority(self):
+        scheduler = JobScheduler()
+        downloads = [LowPriorityJob(print, i) for i in range(0, 5)]
+        for job in downloads:
+            scheduler.push(job)
+
+        assert [scheduler.pop() for _ in range(0, 5)] == downloads
+
+    def test_scheduler_weighted_round_robin(self):
+        scheduler = JobScheduler()
+        scheduler.set_group('big', weight=3)
+        for group in ('big', 'small'):
+            for i in range(0, 10):
+                job = LowPriorityJob(print, i)
+                job.group = group
+                scheduler.push(job)
+
+        # 'big' gets three turns for every one 'small' gets, and 'small' isn't starved
+        groups = [scheduler.pop().group for _ in range(0, 8)]
+        assert groups.count('big') == 6
+        assert groups.count('small') == 2
+
+    def test_scheduler_max_concurrent(self):
+        scheduler = JobScheduler()
+        scheduler.set_group('capped', max_concurrent=1)
+        capped = [LowPriorityJob(print, i) for i in range(0, 2)]
+        for job in capped:
+            job.group = 'capped'
+            scheduler.push(job)
+
+        assert scheduler.pop() is capped[0]
+        assert scheduler.pop() is None
+
+        scheduler.done(capped[0])
+        assert scheduler.pop() is capped[1]
+
+    def test_job_queue_retire_and_shutdown(self):
+        job_queue = JobQueue()
+        job = LowPriorityJob(print)
+        job_queue.put(job)
+
+        # retiring takes effect before the next job
+        job_queue.retire(1)
+        assert job_queue.get() is None
+        assert job_queue.get() is job
+
+        job_queue.shutdown()
+        assert job_queue.get() is None
+
+    def test_drain(self):
+        job_queue = JobQueue()
+        running = LowPriorityJob(print)
+        queued = LowPriorityJob(print)
+        job_queue.put(running)
+        job_queue.put(queued)
+        assert job_queue.get() is running
+
+        job_queue.drain()
+        with pytest.raises(Empty):
+            job_queue.get(block=False)
+        assert job_queue.join(0.01) is False
+
+        # the queued job is left, but there's nothing running any more
+        job_queue.task_done(running)
+        assert job_queue.join(0.01) is True
+        assert job_queue.qsize() == 1
+
+    def test_on_failure(self):
+        attempts = []
+        failures = []
+
+        def flaky(exception):
+            attempts.append(exception)
+            raise exception
+
+        with ThreadPool(1) as thread_pool:
+            for exception in (RetryableException('retry'), ValueError('broken')):
+                job = LowPriorityJob(flaky, exception)
+                job.on_failure = lambda e=exception: failures.append(e)
+                thread_pool.add_job(job)
+
+        # only called once the retries run out, or straight away for anything else
+        assert len(attempts) == JOB_MAX_RETRIES + 2
+        assert [str(e) for e in failures] == ['retry', 'broken']
+
+    def test_cancelled(self):
+        attempts = []
+        failures = []
+
+        def cancelled():
+            attempts.append(1)
+            raise RequestCancelledException('cancelled')
+
+        with ThreadPool(1) as thread_pool:
+            job = LowPriorityJob(cancelled)
+            job.on_failure = lambda: failures.append(1)
+            thread_pool.add_job(job)
+
+        # not retried, and not a failure either
+        assert len(attempts) == 1
+        assert failures == []
+        assert thread_pool.metrics.retries == 0
+
+    def test_resize(self):
+        ran = []
+        with ThreadPool(4, min_workers=1) as thread_pool:
+            thread_pool.start()
+            assert thread_pool.workers == 1
+            thread_pool.resize(3)
+            for i in range(0, 10):
+                thread_pool.add_job(LowPriorityJob(ran.append, i))
+        assert sorted(ran) == list(range(0, 10))
+        assert not any(worker.is_alive() for worker in thread_pool.threads)
+
+    def test_resize_forgets_retired_workers(self):
+        with ThreadPool(4, min_workers=1) as thread_pool:
+            thread_pool.start()
+            for _ in range(0, 5):
+                thread_pool.resize(4)
+                thread_pool.resize(1)
+                deadline = time.monotonic() + 5
+                while sum(worker.is_alive() for worker in thread_pool.threads) > 1 and time.monotonic() < deadline:
+                    time.sleep(0.01)
+            thread_pool.resize(2)
+            assert len(thread_pool.threads) == 2
+
+    def test_autoscaler(self):
+        autoscaler = Autoscaler(1, 4)
+        assert autoscaler.step(1, 100) == 2
+        assert autoscaler.step(2, 200) == 3
+        # throughput dropped with the third worker, so go back down
+        assert autoscaler.step(3, 150) == 2
+        assert autoscaler.step(2, 200) == 1
+        # can't go below the minimum, so turn around
+        assert autoscaler.step(1, 210) == 2
@@ -0,0 +1,35 @@
+import hashlib
+
+from e621sync.verify import expected_md5, relist_mark, find_files, hash_file, verify_directories
+
+GOOD_DATA = b'good data'
+GOOD_MD5 = hashlib.md5(GOOD_DATA).hexdigest()
+BAD_MD5 = hashlib.md5(b'something else').hexdigest()
+
+
+class TestVerify:
+    def test_expected_md5(self):
+        assert expected_md5('123_{}.png'.format(GOOD_MD5)) == GOOD_MD5
+        assert expected_md5('./foo/0001_123_{}.webm'.format(GOOD_MD5)) == GOOD_MD5
+        assert expected_md5('{}.gif'.format(GOOD_MD5)) == GOOD_MD5
+        assert expected_md5('notes.txt') is None
+
+    def test_relist_mark(self):
+        assert relist_mark('./foo/123_{}.png'.format(GOOD_MD5), pool=False) == 122
+        assert relist_mark('./foo/0007_123_{}.png'.format(GOOD_MD5), pool=True) == 7
+        assert relist_mark('./foo/0007_123_{}.png'.format(GOOD_MD5), pool=False) is None
+        assert relist_mark('{}.png'.format(GOOD_MD5), pool=False) is None
+
+    def test_verify_directories(self, tmpdir):
+        tmpdir.join('rule', '1_{}.png'.format(GOOD_MD5)).write_binary(GOOD_DATA, ensure=True)
+        tmpdir.join('rule', '2_{}.png'.format(BAD_MD5)).write_binary(GOOD_DATA)
+        tmpdir.join('rule', '3_{}.png.part'.format(BAD_MD5)).write_binary(b'')
+        tmpdir.join('store', 'ab', '{}.png'.format(BAD_MD5)).write_binary(b'', ensure=True)
+
+        directories = [str(tmpdir.join('rule')), str(tmpdir.join('store')), str(tmpdir.join('missing'))]
+        assert len(list(find_files(directories[0]))) == 2
+        assert hash_file(str(tmpdir.join('rule', '1_{}.png'.format(GOOD_MD5))))[1] == GOOD_MD5
+
+        bad = sorted(filename for filename, expected, actual in verify_directories(directories, processes=2))
+        assert bad == [str(tmpdir.join('rule', '2_{}.png'.format(BAD_MD5))),
+                       str(tmpdir.join('store', 'ab', '{}.png'.format(BAD_MD5)))]